@@ -1,15 +1,29 @@
 # api.py - Baskin Robbins 31 Game API
 
+import logging
+import time
+
 import endpoints
-from protorpc import messages, message_types, remote
+from protorpc import messages, remote
 
 from google.appengine.ext import ndb
 
-from models import User, Game, MoveRecord, Score, StringMessage
+import engine
+import leaderboard
+import lobby
+import ratings
+import solver
+from instrumentation import instrumented
+from ratelimit import rate_limited
+from models import User, Game, Score, LobbyTicket, StringMessage
 from models import (
-    GameForm, GameForms, NewGameForm, MakeMoveForm, GameHistoryForm,
-    UserForms, ScoreForms)
-from utils import get_by_urlsafe, get_games_by_username, get_user_by_gplus
+    GameForm, GameSummaryForms, GameStatus, NewGameForm, MakeMoveForm,
+    GameHistoryForm, HintForm, UserForm, UserForms, ScoreForms,
+    BatchMovesForm, MoveResultForm, MoveResultForms, LobbyForm,
+    LobbyTicketForm)
+from utils import (
+    get_game, get_games, cache_game, save_game_async,
+    get_game_summaries_by_username, get_user_by_gplus)
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
@@ -17,12 +31,64 @@ API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 # REQUEST MESSAGES
 USER_REQUEST = endpoints.ResourceContainer(
     username=messages.StringField(1, required=True))
+USER_GAMES_REQUEST = endpoints.ResourceContainer(
+    username=messages.StringField(1, required=True),
+    status=messages.EnumField(GameStatus, 2, default=GameStatus.ALL),
+    limit=messages.IntegerField(3, default=20),
+    cursor=messages.StringField(4))
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
+LOBBY_REQUEST = endpoints.ResourceContainer(LobbyForm)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1, required=True))
 GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1, required=True))
+GET_GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1, required=True),
+    version=messages.IntegerField(2))
+WAIT_GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1, required=True),
+    version=messages.IntegerField(2, required=True),
+    timeout=messages.IntegerField(3, default=20))
+RANKINGS_REQUEST = endpoints.ResourceContainer(
+    limit=messages.IntegerField(1, default=25),
+    offset=messages.IntegerField(2, default=0))
+LOBBY_TICKET_REQUEST = endpoints.ResourceContainer(
+    ticket=messages.StringField(1, required=True))
+USER_RANK_REQUEST = endpoints.ResourceContainer(
+    username=messages.StringField(1, required=True),
+    neighbours=messages.IntegerField(2, default=5))
+
+MAX_RANKINGS_PAGE = 100
+MAX_GAMES_PAGE = 100
+MAX_BOTS = 8
+MAX_BATCH_MOVES = 200
+# game_over is implied by these filters, so it is not projected
+STATUS_GAME_OVER = {
+    GameStatus.ACTIVE: False,
+    GameStatus.FINISHED: True,
+    GameStatus.WON: True,
+    GameStatus.LOST: True,
+}
+# Long-polling holds a request open, so keep it well under the deadline.
+# Each waiting client holds an instance's request slot while it waits, see
+# wait_for_game in the README for what that costs
+MAX_WAIT_SECONDS = 25
+WAIT_POLL_INTERVAL = 0.5
+
+
+def _ranked_forms(entries):
+    """Returns UserForms for a list of (rank, name, rating) tuples"""
+    return [UserForm(rank=rank, name=name, rating=rating)
+            for rank, name, rating in entries]
+
+
+def _not_modified_form(game):
+    """Returns a GameForm telling the client its copy of game is current"""
+    return GameForm(urlsafe_game_key=game.key.urlsafe(),
+                    version=game.version,
+                    not_modified=True,
+                    message="Not modified")
 
 
 @endpoints.api(name='baskin_robbins_31', version='v1',
@@ -37,59 +103,70 @@ class BaskinRobbins31Game(remote.Service):
                       path='create_user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a new user from user's gplus account (by oauth2)"""
         g_user = endpoints.get_current_user()
         if not g_user:
             raise endpoints.UnauthorizedException('Authorization required')
-        if User.query(User.name == request.username).get():
-            raise endpoints.ConflictException(
-                "A User with that name already exists.")
-        if User.query(User.email == g_user.email()).get():
-            raise endpoints.ConflictException(
-                "A User with that Google plus account already exists.")
-        user = User(name=request.username, email=g_user.email())
-        user.put()
+        try:
+            user = User.create(name=request.username, email=g_user.email())
+        except ValueError as error:
+            raise endpoints.ConflictException(error)
+        leaderboard.update_ratings([(user.name, None, user.rating)])
         return StringMessage(message="User %s created" % request.username)
 
-    # TODO: add optional params to request for completed games, won, lost, etc.
-    @endpoints.method(request_message=USER_REQUEST,
-                      response_message=GameForms,
+    @endpoints.method(request_message=USER_GAMES_REQUEST,
+                      response_message=GameSummaryForms,
                       path='user/{username}/games',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
+    @rate_limited(rate=2, burst=10)
     def get_user_games(self, request):
-        """Get a user's games (by unique username)"""
-        games = get_games_by_username(request.username)
-        return GameForms(games=[game.to_form() for game in games])
+        """Get a page of a user's games (by unique username), newest first"""
+        if not 0 < request.limit <= MAX_GAMES_PAGE:
+            raise endpoints.BadRequestException(
+                "limit must be between 1 and %d" % MAX_GAMES_PAGE)
+        games, next_cursor = get_game_summaries_by_username(
+            request.username, request.status, request.limit, request.cursor)
+        game_over = STATUS_GAME_OVER.get(request.status)
+        return GameSummaryForms(
+            games=[game.to_summary_form(game_over) for game in games],
+            next_cursor=next_cursor)
 
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=ScoreForms,
                       path='user/{username}/scores',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
         """Get a user's scores (by unique username)"""
-        user = User.query(User.name == request.username).get()
+        user = User.get_by_name(request.username)
         if not user:
             raise endpoints.NotFoundException("User doesn't exist")
-        scores = Score.query(ancestor=user.key).fetch()
+        scores = Score.query(Score.user == user.key).fetch_async()
+        # Scores not yet moved into their game's entity group by MigrateScores
+        legacy = Score.query(ancestor=user.key).fetch_async()
+        scores = scores.get_result() + legacy.get_result()
         if not scores:
             raise endpoints.NotFoundException(
                 "That user hasn't recorded any scores yet")
-        return ScoreForms(scores=[score.to_form() for score in scores])
+        return ScoreForms(scores=[score.to_form(user.name)
+                                  for score in scores])
 
     @endpoints.method(request_message=GAME_REQUEST,
                       response_message=GameForm,
                       path='quit_game',
                       name='quit_game',
                       http_method='POST')
+    @instrumented
     def quit_game(self, request):
         """Authorized user forfeits a current game"""
         user = get_user_by_gplus()
-        users_games = get_games_by_username(user.name)
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game not in users_games:
+        game = get_game(request.urlsafe_game_key)
+        if user.name not in game.users:
             raise endpoints.ForbiddenException('User not part of game')
         if game.game_over:
             raise endpoints.ForbiddenException('Game has already finished')
@@ -99,16 +176,44 @@ class BaskinRobbins31Game(remote.Service):
         self._save_move_results(**gameResultsToSave)
         return game.to_form(message="%s has quit. Game over!" % user.name)
 
-    @endpoints.method(request_message=message_types.VoidMessage,
+    @endpoints.method(request_message=RANKINGS_REQUEST,
                       response_message=UserForms,
                       path='rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
+    @rate_limited(rate=1, burst=5)
     def get_user_rankings(self, request):
-        """Get list of all users, ordered by rating"""
-        rankings = User.query().order(-User.rating).fetch(
-            projection=[User.name, User.rating])
-        return UserForms(users=[user.to_form() for user in rankings])
+        """Get a page of users, ordered by rating"""
+        if request.offset < 0:
+            raise endpoints.BadRequestException("offset must not be negative")
+        if not 0 < request.limit <= MAX_RANKINGS_PAGE:
+            raise endpoints.BadRequestException(
+                "limit must be between 1 and %d" % MAX_RANKINGS_PAGE)
+        entries, total = leaderboard.get_page(request.offset, request.limit)
+        next_offset = request.offset + len(entries)
+        return UserForms(users=_ranked_forms(entries),
+                         next_offset=next_offset if next_offset < total
+                         else None)
+
+    @endpoints.method(request_message=USER_RANK_REQUEST,
+                      response_message=UserForms,
+                      path='rankings/{username}',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrumented
+    @rate_limited(rate=2, burst=10)
+    def get_user_rank(self, request):
+        """Get a user's rank along with their neighbours in the rankings"""
+        user = User.get_by_name(request.username)
+        if not user:
+            raise endpoints.NotFoundException("User doesn't exist")
+        neighbours = min(max(request.neighbours, 0), MAX_RANKINGS_PAGE // 2)
+        entries = leaderboard.get_rank(user.name, user.rating, neighbours)
+        if entries is None:
+            raise endpoints.NotFoundException(
+                "User is not ranked yet, try again shortly")
+        return UserForms(users=_ranked_forms(entries))
 
     # GAME METHODS
     @endpoints.method(request_message=NEW_GAME_REQUEST,
@@ -116,16 +221,29 @@ class BaskinRobbins31Game(remote.Service):
                       path='new_game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
+    @rate_limited(rate=1, burst=5)
     def new_game(self, request):
         """Create a new game"""
-        user = get_user_by_gplus()
         players = request.other_players
+        if not 0 <= request.bots <= MAX_BOTS:
+            raise endpoints.BadRequestException(
+                "bots must be between 0 and %d" % MAX_BOTS)
+        # Look up every invited player in one concurrent batch
+        players_future = User.get_by_names_async(players)
+        user = get_user_by_gplus()
 
-        for p in players:
-            player = User.query(User.name == p).get()
+        bots = []
+        for p, player in zip(players, players_future.get_result()):
             if not player:
                 raise endpoints.NotFoundException(
                     "User %s doesn't not exist." % p)
+            if player.bot:
+                bots.append(player.name)
+        for bot in User.get_bots(request.bots):
+            if bot.name not in players:
+                players.append(bot.name)
+                bots.append(bot.name)
 
         players.append(user.name)
 
@@ -133,20 +251,98 @@ class BaskinRobbins31Game(remote.Service):
             game = Game.new_game(current_int=request.starting_int,
                                  max_int=request.max_int,
                                  max_increment=request.max_increment,
-                                 players=players)
+                                 players=players,
+                                 compact_history=request.compact_history,
+                                 bots=bots)
         except ValueError as error:
             raise endpoints.BadRequestException(error)
 
-        return game.to_form(message="New game created")
+        messages = ["New game created"]
+        if game.users[0] in game.bots:
+            moveResultsToSave = {'moves': []}
+            messages.extend(game.play_bots(moveResultsToSave))
+            self._save_move_results(game=game, **moveResultsToSave)
+        else:
+            cache_game(game)
+        return game.to_form(message=' '.join(messages))
 
-    @endpoints.method(request_message=GAME_REQUEST,
+    @endpoints.method(request_message=LOBBY_REQUEST,
+                      response_message=LobbyTicketForm,
+                      path='lobby',
+                      name='join_lobby',
+                      http_method='POST')
+    @instrumented
+    @rate_limited(rate=1, burst=5)
+    def join_lobby(self, request):
+        """Join the lobby to be matched into a new game with these settings.
+           Returns a ticket to check for the game with get_lobby_ticket"""
+        if not 2 <= request.players <= lobby.MAX_PLAYERS:
+            raise endpoints.BadRequestException(
+                "players must be between 2 and %d" % lobby.MAX_PLAYERS)
+        try:
+            engine.check_settings(range(request.players), 0,
+                                  request.max_int, request.max_increment)
+        except ValueError as error:
+            raise endpoints.BadRequestException(error)
+        user = get_user_by_gplus()
+        ticket = lobby.join(user.name, request.max_int,
+                            request.max_increment, request.players)
+        return LobbyTicketForm(ticket=ticket, matched=False,
+                               message="Waiting for other players")
+
+    @endpoints.method(request_message=LOBBY_TICKET_REQUEST,
+                      response_message=LobbyTicketForm,
+                      path='lobby/{ticket}',
+                      name='get_lobby_ticket',
+                      http_method='GET')
+    @instrumented
+    def get_lobby_ticket(self, request):
+        """Check whether a lobby ticket has been matched into a game"""
+        ticket = LobbyTicket.get_by_id(request.ticket)
+        form = LobbyTicketForm(ticket=request.ticket, matched=False)
+        if not ticket:
+            form.message = "Waiting for other players"
+        elif ticket.expired:
+            form.message = "No game was found in time, join again"
+        else:
+            form.matched = True
+            form.urlsafe_game_key = ticket.game_key.urlsafe()
+            form.message = "Matched into a new game"
+        return form
+
+    @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
+    @rate_limited(rate=5, burst=20)
     def get_game(self, request):
-        """Get game by URL safe key"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Get game by URL safe key. If the client's version is current, only
+           a not modified response is returned"""
+        game = get_game(request.urlsafe_game_key)
+        if request.version is not None and request.version == game.version:
+            return _not_modified_form(game)
+        return game.to_form()
+
+    @endpoints.method(request_message=WAIT_GAME_REQUEST,
+                      response_message=GameForm,
+                      path='game/{urlsafe_game_key}/wait',
+                      name='wait_for_game',
+                      http_method='GET')
+    @instrumented
+    @rate_limited(rate=1, burst=5)
+    def wait_for_game(self, request):
+        """Long-poll a game. Returns as soon as the game's version differs
+           from the client's, or a not modified response after timeout"""
+        timeout = min(max(request.timeout, 0), MAX_WAIT_SECONDS)
+        deadline = time.time() + timeout
+        game = get_game(request.urlsafe_game_key)
+        while game.version == request.version and time.time() < deadline:
+            time.sleep(WAIT_POLL_INTERVAL)
+            game = get_game(request.urlsafe_game_key)
+        if game.version == request.version:
+            return _not_modified_form(game)
         return game.to_form()
 
     @endpoints.method(request_message=GAME_REQUEST,
@@ -154,61 +350,159 @@ class BaskinRobbins31Game(remote.Service):
                       path='game/{urlsafe_game_key}/scores',
                       name='get_game_scores',
                       http_method='GET')
+    @instrumented
     def get_game_scores(self, request):
         """Get game scores by game's urlsafe key"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = get_game(request.urlsafe_game_key)
         if not game.game_over:
             raise endpoints.BadRequestException("Game has not finished yet")
+        if game.loser:
+            return ScoreForms(scores=game.score_forms())
+        # Games finished before results were stored on Game
         scores = Score.query(Score.game_key == game.key).fetch()
-        return ScoreForms(scores=[score.to_form() for score in scores])
+        users = ndb.get_multi([score.user_key for score in scores
+                               if not score.username])
+        names = dict((user.key, user.name) for user in users if user)
+        return ScoreForms(scores=[score.to_form(names.get(score.user_key))
+                                  for score in scores])
+
+    @endpoints.method(request_message=GAME_REQUEST,
+                      response_message=HintForm,
+                      path='game/{urlsafe_game_key}/hint',
+                      name='get_hint',
+                      http_method='GET')
+    @instrumented
+    @rate_limited(rate=2, burst=10)
+    def get_hint(self, request):
+        """Suggest the best move for the player whose turn it is"""
+        game = get_game(request.urlsafe_game_key)
+        if game.game_over:
+            raise endpoints.BadRequestException("Game has already finished")
+        hint = solver.best_move(game.current_int, game.max_int,
+                                game.max_increment, len(game.users))
+        if hint.loser_offset:
+            message = "Add %d to make %s the loser." % (
+                hint.value, game.users[hint.loser_offset])
+        else:
+            message = ("%s can't avoid losing against best play, "
+                       "add %d to hope for a mistake." % (
+                           game.users[0], hint.value))
+        return HintForm(value=hint.value, can_win=hint.loser_offset != 0,
+                        message=message)
 
     @endpoints.method(request_message=GAME_REQUEST,
                       response_message=GameHistoryForm,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
         """Get game history by game's urlsafe key"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            moves = MoveRecord.query(
-                ancestor=game.key).order(MoveRecord.datetime).fetch()
+        game = get_game(request.urlsafe_game_key)
+        moves = game.history()
         return GameHistoryForm(moves=[move.to_form() for move in moves])
 
-    @ndb.transactional(xg=True)
-    def _save_move_results(self, game, move, winners=None,
-                           loser=None, scores=None):
-        """NDB Transaction to update datastore entities after valid move"""
-        game.put()
-        move.put()
-        if winners and loser and scores:
-            ndb.put_multi(winners)
-            ndb.put_multi(scores)
-            loser.put()
+    @instrumented
+    def _save_move_results(self, game, moves, scores=None):
+        """Saves entities after valid move and writes the new game state
+           through to the game cache. Rating changes for a finished game are
+           applied asynchronously by the ratings pipeline"""
+        self._save_move_results_async(game, moves, scores=scores).get_result()
+        if scores:
+            ratings.schedule_apply()
+
+    def _save_move_results_async(self, game, moves, scores=None):
+        """Future version of _save_move_results, which leaves scheduling the
+           rating update to the caller"""
+        return save_game_async(game, moves, scores=scores)
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
+    @rate_limited(rate=5, burst=10)
     def make_move(self, request):
         """Next player makes their move. Returns the updated game state"""
         user = get_user_by_gplus()
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = get_game(request.urlsafe_game_key)
         move_value = request.value
 
-        if game.game_over:
-            return game.to_form(message="Game has already finished!")
-        if user.name not in game.users:
-            return game.to_form(message="User not part of game")
-        if user.name != game.users[0]:
-            return game.to_form(message="Not user's turn yet")
-        if move_value > game.max_increment or move_value < 1:
-            return game.to_form(message="Invalid move value")
+        # Rejected moves are answered from the cached game, without touching
+        # the datastore
+        error = engine.validate_move(game.state(), user.name, move_value)
+        if error:
+            return game.to_form(message=error)
 
         moveResultsToSave, message = game.make_move(move_value)
 
         self._save_move_results(**moveResultsToSave)
         return game.to_form(message=message)
 
+    @endpoints.method(request_message=BatchMovesForm,
+                      response_message=MoveResultForms,
+                      path='moves',
+                      name='make_moves',
+                      http_method='POST')
+    @instrumented
+    @rate_limited(rate=1, burst=5)
+    def make_moves(self, request):
+        """Makes the user's moves in many games at once. Moves are validated
+           like make_move and each game is saved in its own transaction, so
+           every move gets its own result"""
+        if len(request.moves) > MAX_BATCH_MOVES:
+            raise endpoints.BadRequestException(
+                "At most %d moves can be made at once" % MAX_BATCH_MOVES)
+        user = get_user_by_gplus()
+        games = get_games([move.urlsafe_game_key for move in request.moves])
+
+        results = []
+        pending = []
+        seen = set()
+        for move in request.moves:
+            urlsafe_key = move.urlsafe_game_key
+            game = games.get(urlsafe_key)
+            if not game:
+                results.append(MoveResultForm(urlsafe_game_key=urlsafe_key,
+                                              success=False,
+                                              message="Game not found"))
+                continue
+            error = engine.validate_move(game.state(), user.name, move.value)
+            if not error and urlsafe_key in seen:
+                error = "Only one move per game can be made at once"
+            seen.add(urlsafe_key)
+            if error:
+                results.append(MoveResultForm(urlsafe_game_key=urlsafe_key,
+                                              success=False, message=error,
+                                              game=game.to_form()))
+                continue
+            moveResultsToSave, message = game.make_move(move.value)
+            # Transactions for all games run concurrently
+            future = self._save_move_results_async(**moveResultsToSave)
+            results.append(MoveResultForm(urlsafe_game_key=urlsafe_key,
+                                          success=True, message=message))
+            pending.append((results[-1], game, future,
+                            'scores' in moveResultsToSave))
+
+        finished = False
+        for result, game, future, scores in pending:
+            try:
+                future.get_result()
+            except endpoints.ConflictException as e:
+                result.success = False
+                result.message = e.message
+                continue
+            except Exception:
+                logging.exception('Failed to save move in %s',
+                                  result.urlsafe_game_key)
+                result.success = False
+                result.message = "Move could not be saved, try again"
+                continue
+            result.game = game.to_form()
+            finished = finished or scores
+        if finished:
+            ratings.schedule_apply()
+        return MoveResultForms(results=results)
+
 api = endpoints.api_server([BaskinRobbins31Game])
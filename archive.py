@@ -0,0 +1,56 @@
+# archive.py - archival of finished games for Baskin Robbins 31 Game API
+
+import logging
+from datetime import datetime, timedelta
+
+from google.appengine.ext import ndb
+
+from models import ArchivedGame, Game, MoveRecord
+from utils import uncache_game
+
+ARCHIVE_URL = '/tasks/archive_games'
+# Finished games stay in the Game kind this long, while players are still
+# likely to look at them
+ARCHIVE_AFTER = timedelta(days=1)
+ARCHIVE_BATCH_SIZE = 100
+
+
+@ndb.transactional_tasklet(xg=True)
+def _archive_game(game_key):
+    """Replaces a finished game and its MoveRecords with an ArchivedGame.
+       Games whose results haven't been backfilled yet are left alone, as
+       archived games are listed by their winners and loser"""
+    game = yield game_key.get_async()
+    if not game or not game.game_over or not game.loser:
+        raise ndb.Return(False)
+    move_keys = []
+    if not game.compact_history:
+        moves = yield MoveRecord.query(ancestor=game_key).order(
+            MoveRecord.datetime).fetch_async()
+        game._pack_records(moves)
+        move_keys = [move.key for move in moves]
+    yield (ArchivedGame.from_game(game).put_async(),
+           ndb.delete_multi_async([game_key] + move_keys))
+    raise ndb.Return(True)
+
+
+def archive(cursor=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """Archives one page of games that finished before ARCHIVE_AFTER, each in
+       its own transaction. Returns the cursor for the next page, or None
+       when all games are done"""
+    cutoff = datetime.now() - ARCHIVE_AFTER
+    game_keys, next_cursor, more = Game.query(
+        Game.game_over == True, Game.last_update < cutoff).fetch_page(
+            batch_size, start_cursor=cursor, keys_only=True)
+    futures = [_archive_game(game_key) for game_key in game_keys]
+    for game_key, future in zip(game_keys, futures):
+        try:
+            archived = future.get_result()
+        except Exception:
+            # Left in place, the next run picks the game up again
+            logging.exception('Failed to archive %s', game_key)
+            continue
+        if archived:
+            # A cached copy may still point at the deleted MoveRecords
+            uncache_game(game_key)
+    return next_cursor if more else None
@@ -0,0 +1,690 @@
+#!/usr/bin/env python
+# benchmark.py - benchmark and load generator for Baskin Robbins 31 Game API
+"""Drives the BaskinRobbins31Game endpoints and the cron/task handlers
+directly against the App Engine testbed stubs with a synthetic population,
+and reports per-operation p50/p99 latency, RPC counts and entity writes as
+JSON so results can be compared across commits.
+
+Usage:
+    python benchmark.py --sdk /path/to/google_appengine [--users 200]
+        [--games 100] [--moves 2000] [--seed 31] [--max-ranked-users 1000000]
+        [--output results.json] [--compare baseline.json] [scenario ...]
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Results compared against the baseline given with --compare
+COMPARED_FIELDS = ('p50_ms', 'p99_ms', 'datastore_rpcs_per_call',
+                   'entity_writes_per_call')
+# Game sizes compared by the players scenario
+PLAYER_COUNTS = (2, 8, 32)
+# The waiters scenario spreads one long-poll per user over this many games
+WAIT_GAMES = 10
+WAIT_TIMEOUT = 10
+# User base sizes for the rankings scenario, up to --max-ranked-users
+RANKINGS_SIZES = (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6)
+
+
+def _setup_sdk(sdk_path):
+    """Puts the App Engine SDK and its bundled libraries on sys.path"""
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    try:
+        import dev_appserver
+    except ImportError:
+        raise ImportError('App Engine SDK not found at %s, pass --sdk or set '
+                          'APPENGINE_SDK' % (sdk_path or 'sys.path'))
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+def _percentile(values, percent):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    index = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class Recorder(object):
+    """Collects latency, RPC counts and entity writes per operation"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+        self._rpcs = None
+        self._writes = 0
+
+    def hook(self, service, call, request, response):
+        """apiproxy pre-call hook counting RPCs made while measuring"""
+        if self._rpcs is None:
+            return
+        self._rpcs['%s.%s' % (service, call)] += 1
+        if service == 'datastore_v3':
+            if call == 'Put':
+                self._writes += len(request.entity_list())
+            elif call == 'Delete':
+                self._writes += len(request.key_list())
+
+    def measure(self, name, func, *args, **kwargs):
+        """Runs func as a fresh request and records it under name. Returns
+           func's result, or None if it raised an endpoints exception"""
+        import endpoints
+        from google.appengine.ext import ndb
+
+        ndb.get_context().clear_cache()
+        self._rpcs = Counter()
+        self._writes = 0
+        start = time.time()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+        except endpoints.ServiceException:
+            self.errors[name] += 1
+        finally:
+            elapsed = time.time() - start
+            self.samples[name].append((elapsed, self._rpcs, self._writes))
+            self._rpcs = None
+        return result
+
+    def report(self):
+        results = OrderedDict()
+        for name in sorted(self.samples):
+            samples = self.samples[name]
+            count = len(samples)
+            times = sorted(sample[0] * 1000 for sample in samples)
+            rpcs = Counter()
+            for sample in samples:
+                rpcs.update(sample[1])
+            datastore_rpcs = sum(value for key, value in rpcs.items()
+                                 if key.startswith('datastore_v3.'))
+            results[name] = OrderedDict([
+                ('count', count),
+                ('errors', self.errors[name]),
+                ('p50_ms', round(_percentile(times, 50), 3)),
+                ('p99_ms', round(_percentile(times, 99), 3)),
+                ('mean_ms', round(sum(times) / count, 3)),
+                ('datastore_rpcs_per_call',
+                 round(float(datastore_rpcs) / count, 3)),
+                ('entity_writes_per_call',
+                 round(float(sum(sample[2] for sample in samples)) / count,
+                       3)),
+                ('rpcs_per_call', OrderedDict(
+                    (key, round(float(rpcs[key]) / count, 3))
+                    for key in sorted(rpcs))),
+            ])
+        return results
+
+
+class Benchmark(object):
+    """Testbed environment plus helpers to call endpoints and handlers"""
+
+    def __init__(self, seed):
+        import endpoints
+        from google.appengine.api import apiproxy_stub_map, users
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.random = random.Random(seed)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.taskqueue = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+
+        self.recorder = Recorder()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'benchmark', self.recorder.hook)
+
+        # Endpoints authenticates through get_current_user, so the harness
+        # decides which user each call is made as
+        self.current_email = None
+        endpoints.get_current_user = lambda: (
+            users.User(self.current_email) if self.current_email else None)
+
+        import api
+        import main
+        import ratelimit
+        self.api = api
+        # Scenarios call endpoints far faster than real clients, so limits
+        # are lifted everywhere but in the ratelimit scenario
+        for name in ratelimit.DEFAULT_LIMITS:
+            ratelimit.LIMITS[name] = (1e9, 10 ** 9)
+        self.main = main
+        self.service = api.BaskinRobbins31Game()
+
+        # Shared state built up by the scenarios
+        self.usernames = []
+        self.games = []
+
+    def close(self):
+        self.testbed.deactivate()
+
+    def call(self, method_name, as_user=None, **fields):
+        """Calls an endpoint method as the given username"""
+        method = getattr(self.service, method_name)
+        request = method.remote.request_type(**fields)
+        self.current_email = '%s@example.com' % as_user if as_user else None
+        return self.recorder.measure(method_name, method, request)
+
+    def handle(self, name, url, method='GET', body='', headers=None):
+        """Sends a request to a cron or task handler in main.py"""
+        import webapp2
+        request = webapp2.Request.blank(url, method=method, body=body,
+                                        headers=headers or {})
+        response = self.recorder.measure(
+            name, request.get_response, self.main.app)
+        if response.status_int >= 400:
+            self.recorder.errors[name] += 1
+        return response
+
+    def drain_tasks(self):
+        """Runs queued push tasks, including ones they enqueue, until none
+           remain. Pull queues are left to the code that leases them"""
+        while True:
+            ran = False
+            for queue in self.taskqueue.GetQueues():
+                if queue.get('mode') == 'pull':
+                    continue
+                queue_name = queue['name']
+                for task in self.taskqueue.get_filtered_tasks(
+                        queue_names=[queue_name]):
+                    self.taskqueue.DeleteTask(queue_name, task.name)
+                    self.handle('task:%s' % task.url, task.url,
+                                method=task.method, body=task.payload or '',
+                                headers=dict(task.headers))
+                    ran = True
+            if not ran:
+                return
+
+
+def _measure_endpoint(bench, name, method_name, as_user=None, **fields):
+    """Calls an endpoint method as the given username, recorded under name"""
+    method = getattr(bench.service, method_name)
+    request = method.remote.request_type(**fields)
+    bench.current_email = '%s@example.com' % as_user if as_user else None
+    return bench.recorder.measure(name, method, request)
+
+
+def populate_users(bench, args):
+    """Creates the synthetic user population"""
+    for i in range(args.users):
+        name = 'user%d' % i
+        bench.call('create_user', as_user=name, username=name)
+        bench.usernames.append(name)
+
+
+def create_games(bench, args):
+    """Creates games between 2 to 4 random players"""
+    for i in range(args.games):
+        players = bench.random.sample(
+            bench.usernames, bench.random.randint(2, 4))
+        form = bench.call('new_game', as_user=players[0],
+                          other_players=players[1:])
+        if form:
+            bench.games.append(form.urlsafe_game_key)
+
+
+def play_games(bench, args):
+    """Plays a realistic mix: clients poll their game before moving, some
+       players quit, and others browse rankings, histories and scores"""
+    finished = []
+    for i in range(args.moves):
+        if not bench.games:
+            break
+        game_key = bench.random.choice(bench.games)
+        game = bench.call('get_game', urlsafe_game_key=game_key)
+        if not game:
+            continue
+        if game.game_over:
+            bench.games.remove(game_key)
+            finished.append(game_key)
+            continue
+
+        player = game.users[0]
+        if bench.random.random() < 0.03:
+            bench.call('quit_game', as_user=player,
+                       urlsafe_game_key=game_key)
+        else:
+            bench.call('make_move', as_user=player,
+                       urlsafe_game_key=game_key,
+                       value=bench.random.randint(1, game.max_increment))
+        # A waiting player checks whether anything changed
+        bench.call('get_game', urlsafe_game_key=game_key,
+                   version=game.version)
+
+        roll = bench.random.random()
+        if roll < 0.05:
+            bench.call('get_user_rankings', limit=25,
+                       offset=bench.random.randint(0, len(bench.usernames)))
+        elif roll < 0.08:
+            bench.call('get_user_games',
+                       username=bench.random.choice(bench.usernames))
+        elif roll < 0.10 and finished:
+            finished_key = bench.random.choice(finished)
+            bench.call('get_game_history', urlsafe_game_key=finished_key)
+            bench.call('get_game_scores', urlsafe_game_key=finished_key)
+        elif roll < 0.12:
+            bench.call('get_user_scores',
+                       username=bench.random.choice(bench.usernames))
+
+        if i % 50 == 0:
+            bench.drain_tasks()
+    bench.drain_tasks()
+
+
+def send_reminders(bench, args):
+    """Runs the reminder cron with every active game counted as idle"""
+    from datetime import timedelta
+    import reminders
+    reminders.IDLE_TIME = timedelta(0)
+    bench.handle('cron:send_reminder', '/crons/send_reminder')
+    bench.drain_tasks()
+
+
+def forfeit_games(bench, args):
+    """Runs the forfeit cron with every active game counted as idle"""
+    from datetime import timedelta
+    import forfeits
+    forfeits.IDLE_TIME = timedelta(0)
+    bench.handle('cron:forfeit_idle_games', '/crons/forfeit_idle_games')
+    bench.drain_tasks()
+
+
+def archive_games(bench, args):
+    """Archives every finished game, then reads archived games back through
+       get_game, get_game_history and get_user_games"""
+    from datetime import timedelta
+    from google.appengine.ext import ndb
+    import archive
+    from models import ArchivedGame, Game
+    archive.ARCHIVE_AFTER = timedelta(0)
+    bench.handle('cron:archive_games', '/crons/archive_games')
+    bench.drain_tasks()
+    for key in ArchivedGame.query().fetch(args.games, keys_only=True):
+        game_key = ndb.Key(Game, key.id()).urlsafe()
+        bench.call('get_game', urlsafe_game_key=game_key)
+        bench.call('get_game_history', urlsafe_game_key=game_key)
+    for name in bench.usernames[:args.games]:
+        bench.call('get_user_games', username=name)
+
+
+def compare_player_counts(bench, args):
+    """Plays games of 2, 8 and 32 players to the end, recording new_game,
+       make_move, the move that ends the game and get_game_scores separately
+       for each player count"""
+    for players in PLAYER_COUNTS:
+        if players > len(bench.usernames):
+            break
+        prefix = 'players=%d:' % players
+        for i in range(max(1, args.games // 10)):
+            names = bench.random.sample(bench.usernames, players)
+            form = _measure_endpoint(bench, prefix + 'new_game', 'new_game',
+                                     as_user=names[0],
+                                     other_players=names[1:])
+            while form and not form.game_over:
+                form = _measure_endpoint(
+                    bench, prefix + 'make_move', 'make_move',
+                    as_user=form.users[0],
+                    urlsafe_game_key=form.urlsafe_game_key,
+                    value=bench.random.randint(1, form.max_increment))
+            if not form:
+                continue
+            # The ending move writes every player's score
+            samples = bench.recorder.samples
+            samples[prefix + 'make_move:end'].append(
+                samples[prefix + 'make_move'].pop())
+            _measure_endpoint(bench, prefix + 'get_game_scores',
+                              'get_game_scores',
+                              urlsafe_game_key=form.urlsafe_game_key)
+    bench.drain_tasks()
+
+
+def wait_for_moves(bench, args):
+    """Holds one wait_for_game long-poll per user, spread over a few games,
+       each on its own thread like concurrent requests on an instance. Then
+       makes a move in every game and records how long each waiter took to
+       return after its game's move. Waiters that time out are errors"""
+    import threading
+    games = []
+    for i in range(WAIT_GAMES):
+        players = bench.random.sample(bench.usernames, 2)
+        form = bench.call('new_game', as_user=players[0],
+                          other_players=players[1:])
+        if form:
+            games.append(form)
+
+    method = bench.service.wait_for_game
+    lock = threading.Lock()
+    woken = []
+
+    def wait(form):
+        request = method.remote.request_type(
+            urlsafe_game_key=form.urlsafe_game_key, version=form.version,
+            timeout=WAIT_TIMEOUT)
+        result = method(request)
+        with lock:
+            woken.append((form.urlsafe_game_key, time.time(),
+                          result.not_modified))
+
+    threads = [threading.Thread(target=wait, args=(games[i % len(games)],))
+               for i in range(len(bench.usernames))]
+    for thread in threads:
+        thread.start()
+    # Let every waiter reach its polling loop before the moves are made
+    time.sleep(1)
+
+    # The moves aren't measured, as the waiters' polls would be counted as
+    # their RPCs
+    moved = {}
+    make_move = bench.service.make_move
+    for form in games:
+        bench.current_email = '%s@example.com' % form.users[0]
+        make_move(make_move.remote.request_type(
+            urlsafe_game_key=form.urlsafe_game_key, value=1))
+        moved[form.urlsafe_game_key] = time.time()
+    for thread in threads:
+        thread.join()
+
+    latencies = bench.recorder.samples['wait_for_game:wake_latency']
+    for game_key, returned, not_modified in woken:
+        if not_modified:
+            bench.recorder.errors['wait_for_game:wake_latency'] += 1
+        else:
+            latencies.append((returned - moved[game_key], Counter(), 0))
+    bench.drain_tasks()
+
+
+def solve_positions(bench, args):
+    """Times solver lookups on a cold and a warm table cache, for games
+       with increasingly large max_int values"""
+    import solver
+    for max_int in (31, 10 ** 3, 10 ** 6, 10 ** 9):
+        name = 'solver:max_int=%d' % max_int
+        for players in (2, 4, 8):
+            solver.clear_cache()
+            bench.recorder.measure(name + ':cold', solver.best_move,
+                                   0, max_int, 3, players)
+        for i in range(args.moves):
+            bench.recorder.measure(
+                name, solver.best_move,
+                bench.random.randint(0, max_int - 2), max_int,
+                bench.random.randint(2, 10), bench.random.randint(2, 8))
+
+
+def play_bot_games(bench, args):
+    """Plays games of one user against three server bots, taking hints"""
+    for i in range(args.games):
+        human = bench.random.choice(bench.usernames)
+        form = bench.call('new_game', as_user=human, other_players=[],
+                          bots=3)
+        while form and not form.game_over:
+            hint = bench.call('get_hint',
+                              urlsafe_game_key=form.urlsafe_game_key)
+            form = bench.call('make_move', as_user=human,
+                              urlsafe_game_key=form.urlsafe_game_key,
+                              value=hint.value)
+    bench.drain_tasks()
+
+
+def play_batched_bot_games(bench, args):
+    """Plays one user's games against two bots each with batched moves,
+       taking the solver's move in every game"""
+    from models import BatchMoveForm
+    import solver
+    human = bench.random.choice(bench.usernames)
+    games = []
+    for i in range(args.games):
+        form = bench.call('new_game', as_user=human, other_players=[],
+                          bots=2)
+        if form:
+            games.append(form)
+    while games:
+        moves = [
+            BatchMoveForm(
+                urlsafe_game_key=game.urlsafe_game_key,
+                value=solver.best_move(game.current_int, game.max_int,
+                                       game.max_increment,
+                                       len(game.users)).value)
+            for game in games]
+        forms = bench.call('make_moves', as_user=human, moves=moves)
+        if not forms:
+            break
+        games = [result.game for result in forms.results
+                 if result.success and not result.game.game_over]
+    bench.drain_tasks()
+
+
+def lobby_burst(bench, args):
+    """Joins every user to the lobby at once with one of a few settings, then
+       runs the matcher and records how long each join waited for its game.
+       Joins that can't be matched are counted as errors"""
+    from google.appengine.ext import ndb
+    from models import LobbyTicket
+    settings = [(31, 3, 2), (31, 3, 3), (50, 4, 4)]
+    waiting = {}
+    for name in bench.usernames:
+        max_int, max_increment, players = bench.random.choice(settings)
+        form = bench.call('join_lobby', as_user=name, max_int=max_int,
+                          max_increment=max_increment, players=players)
+        if form:
+            waiting[form.ticket] = time.time()
+
+    latencies = bench.recorder.samples['lobby:match_latency']
+    while waiting:
+        bench.drain_tasks()
+        bench.handle('cron:match_lobby', '/crons/match_lobby')
+        now = time.time()
+        tickets = list(waiting)
+        entities = ndb.get_multi([ndb.Key(LobbyTicket, ticket)
+                                  for ticket in tickets])
+        matched = [ticket for ticket, entity in zip(tickets, entities)
+                   if entity and entity.game_key]
+        if not matched:
+            break
+        for ticket in matched:
+            latencies.append((now - waiting.pop(ticket), Counter(), 0))
+        bench.call('get_lobby_ticket', ticket=matched[0])
+    bench.recorder.errors['lobby:match_latency'] += len(waiting)
+
+
+def rate_limit(bench, args):
+    """Times the rate limiter on its own, against memcache and against the
+       in-process fallback, then bursts get_game calls by one user under the
+       endpoint's real limit"""
+    import ratelimit
+    rate, burst = ratelimit.DEFAULT_LIMITS['get_game']
+    for i in range(args.moves):
+        identity = bench.random.choice(bench.usernames)
+        bench.recorder.measure('ratelimit:take', ratelimit.take,
+                               'get_game', identity, rate, burst)
+        bench.recorder.measure('ratelimit:take_local', ratelimit._take_local,
+                               'get_game:%s' % identity, rate, burst,
+                               time.time())
+
+    game_key = next(iter(bench.games), None)
+    if game_key:
+        # Calls over the limit are counted as errors
+        method = bench.service.get_game
+        request = method.remote.request_type(urlsafe_game_key=game_key)
+        bench.current_email = '%s@example.com' % bench.usernames[0]
+        lifted = ratelimit.LIMITS.pop('get_game')
+        for i in range(burst * 2):
+            bench.recorder.measure('get_game:burst', method, request)
+        ratelimit.LIMITS['get_game'] = lifted
+
+
+def rank_users(bench, args):
+    """Grows a separate population of ranked users from 1k to 1M and, at
+       each size, times a snapshot rebuild, rankings pages and rank lookups
+       at random offsets, incremental rating updates, and reads served while
+       the snapshot is missing. Users are written in bulk rather than through
+       create_user to keep setup time down"""
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+    import leaderboard
+    from models import User
+    count = 0
+    for size in RANKINGS_SIZES:
+        if size > args.max_ranked_users:
+            break
+        while count < size:
+            batch = min(500, size - count)
+            first, last = User.allocate_ids(batch)
+            entities = []
+            for user_id in range(first, last + 1):
+                user = User(key=ndb.Key(User, user_id),
+                            name='ranked%d' % count,
+                            rating=float(bench.random.randint(-100, 100)))
+                entities.append(user)
+                entities.extend(user.index_entities())
+                count += 1
+            ndb.put_multi(entities, use_cache=False, use_memcache=False)
+
+        name = 'rankings:users=%d' % size
+        bench.recorder.measure(name + ':rebuild', leaderboard.rebuild)
+        for i in range(min(args.moves, 200)):
+            _measure_endpoint(bench, name + ':get_user_rankings',
+                              'get_user_rankings', limit=25,
+                              offset=bench.random.randint(0, size - 1))
+            _measure_endpoint(bench, name + ':get_user_rank', 'get_user_rank',
+                              username='ranked%d' % bench.random.randint(
+                                  0, size - 1))
+            rating = float(bench.random.randint(-100, 100))
+            bench.recorder.measure(
+                name + ':update_ratings', leaderboard.update_ratings,
+                [('ranked-new%d-%d' % (size, i), None, rating)])
+
+        # Reads while the snapshot is evicted are served from the User index
+        # and schedule a rebuild, which the drained task then runs
+        memcache.delete(leaderboard.SNAPSHOT_KEY)
+        for i in range(min(args.moves, 20)):
+            _measure_endpoint(bench, name + ':get_user_rankings:cold',
+                              'get_user_rankings', limit=25,
+                              offset=bench.random.randint(0, 1000))
+        bench.drain_tasks()
+
+
+def simulate_games(bench, args):
+    """Times offline engine simulations of random and solver-assisted games,
+       in batches of 10000 games"""
+    import engine
+    for players in (2, 4, 8):
+        name = 'engine:simulate:players=%d' % players
+        for i in range(max(1, args.games // 10)):
+            bench.recorder.measure(name, engine.simulate, 10000, players,
+                                   seed=bench.random.random())
+            bench.recorder.measure(
+                name + ':solver', engine.simulate, 10000, players,
+                strategies={0: engine.solver_strategy},
+                seed=bench.random.random())
+
+
+SCENARIOS = OrderedDict([
+    ('users', populate_users),
+    ('games', create_games),
+    ('players', compare_player_counts),
+    ('play', play_games),
+    ('reminders', send_reminders),
+    ('forfeits', forfeit_games),
+    ('archive', archive_games),
+    ('waiters', wait_for_moves),
+    ('solver', solve_positions),
+    ('bots', play_bot_games),
+    ('batch', play_batched_bot_games),
+    ('lobby', lobby_burst),
+    ('ratelimit', rate_limit),
+    ('simulate', simulate_games),
+    ('rankings', rank_users),
+])
+
+
+def compare(baseline, operations):
+    """Changes from a baseline run's results, for operations in both"""
+    changes = OrderedDict()
+    for name, result in operations.items():
+        before = baseline['operations'].get(name)
+        if not before:
+            continue
+        changes[name] = OrderedDict(
+            (field, OrderedDict([('baseline', before[field]),
+                                 ('change', round(result[field] -
+                                                  before[field], 3))]))
+            for field in COMPARED_FIELDS)
+    return changes
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS),
+                        help='scenarios to run, in order (default: all)')
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--moves', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=31)
+    parser.add_argument('--max-ranked-users', type=int, default=10 ** 6,
+                        help='largest user base for the rankings scenario')
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='report changes from an earlier --output file')
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: %s' % ', '.join(sorted(unknown)))
+
+    _setup_sdk(args.sdk)
+    bench = Benchmark(args.seed)
+    try:
+        for name in args.scenarios:
+            SCENARIOS[name](bench, args)
+        results = OrderedDict([
+            ('commit', _git_commit()),
+            ('params', OrderedDict([
+                ('users', args.users), ('games', args.games),
+                ('moves', args.moves), ('seed', args.seed),
+                ('max_ranked_users', args.max_ranked_users),
+                ('scenarios', args.scenarios)])),
+            ('operations', bench.recorder.report()),
+        ])
+        if args.compare:
+            with open(args.compare) as f:
+                results['comparison'] = compare(json.load(f),
+                                                results['operations'])
+    finally:
+        bench.close()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
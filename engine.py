@@ -0,0 +1,135 @@
+# engine.py - datastore independent game rules for Baskin Robbins 31
+
+import random
+from collections import Counter, namedtuple
+
+import solver
+
+# Effects returned by the engine for the ndb layer to persist. A Moved with
+# a value of None is a quit
+Moved = namedtuple('Moved', ['player', 'value'])
+Ended = namedtuple('Ended', ['loser', 'winners', 'winner_points'])
+
+LOSER_POINTS = -1.0
+
+
+class GameState(object):
+    """In-memory state of a single game. users is in turn order, with the
+       player to move first"""
+    __slots__ = ('current_int', 'max_int', 'max_increment', 'users',
+                 'game_over')
+
+    def __init__(self, current_int, max_int, max_increment, users,
+                 game_over=False):
+        self.current_int = current_int
+        self.max_int = max_int
+        self.max_increment = max_increment
+        self.users = list(users)
+        self.game_over = game_over
+
+
+def check_settings(players, current_int, max_int, max_increment):
+    """Raises ValueError if a new game can't be played with these settings"""
+    if len(players) < 2:
+        raise ValueError("You must specify at least one other player")
+    if len(players) != len(set(players)):
+        raise ValueError("You must only specify unique players")
+    if max_increment < 2:
+        raise ValueError("max_increment must be at least 2")
+    if max_int <= current_int:
+        raise ValueError(
+            "Starting value must be smaller than ending value")
+
+
+def validate_move(state, player, value):
+    """Returns why player can't add value to the game, or None if they can"""
+    if state.game_over:
+        return "Game has already finished!"
+    if player not in state.users:
+        return "User not part of game"
+    if player != state.users[0]:
+        return "Not user's turn yet"
+    if value > state.max_increment or value < 1:
+        return "Invalid move value"
+    return None
+
+
+def _end(state, loser_index):
+    state.game_over = True
+    users = state.users
+    winners = users[:loser_index] + users[loser_index + 1:]
+    return Ended(users[loser_index], winners, 1.0 / len(winners))
+
+
+def apply_move(state, value):
+    """Adds value for the player to move, who loses if the count reaches
+       max_int. Returns the list of effects"""
+    player = state.users[0]
+    state.current_int += value
+    if state.current_int >= state.max_int:
+        return [Moved(player, value), _end(state, 0)]
+    state.users.append(state.users.pop(0))
+    return [Moved(player, value)]
+
+
+def quit_game(state, player):
+    """Ends the game with player as the loser. Returns the list of effects"""
+    return [Moved(player, None), _end(state, state.users.index(player))]
+
+
+def replay(state, moves):
+    """Validates and applies a sequence of (player, value) moves, where a
+       value of None is a quit. Returns all effects, raises ValueError on the
+       first invalid move"""
+    effects = []
+    for player, value in moves:
+        if value is None:
+            if state.game_over or player not in state.users:
+                raise ValueError("%s can't quit this game" % player)
+            effects.extend(quit_game(state, player))
+            continue
+        error = validate_move(state, player, value)
+        if error:
+            raise ValueError(error)
+        effects.extend(apply_move(state, value))
+    return effects
+
+
+def random_strategy(state, rng):
+    return int(rng.random() * state.max_increment) + 1
+
+
+def solver_strategy(state, rng):
+    return solver.best_move(state.current_int, state.max_int,
+                            state.max_increment, len(state.users)).value
+
+
+def simulate(games, players, current_int=0, max_int=31, max_increment=3,
+             strategies=None, seed=None):
+    """Plays games offline and returns (losses, points): Counters keyed by
+       seat index, the order players move in at the start. strategies maps a
+       seat to a strategy(state, rng) returning a move, and defaults to
+       random moves for every seat"""
+    rng = random.Random(seed)
+    seats = range(players)
+    strategies = [(strategies or {}).get(seat, random_strategy)
+                  for seat in seats]
+    losses = Counter()
+    points = Counter()
+    winner_points = 1.0 / (players - 1)
+    for i in xrange(games):
+        state = GameState(current_int, max_int, max_increment, seats)
+        users = state.users
+        # Same rules as apply_move, without building effects
+        while True:
+            seat = users[0]
+            state.current_int += strategies[seat](state, rng)
+            if state.current_int >= max_int:
+                break
+            users.append(users.pop(0))
+        losses[seat] += 1
+        points[seat] += LOSER_POINTS
+        for other in seats:
+            if other != seat:
+                points[other] += winner_points
+    return losses, points
@@ -0,0 +1,90 @@
+# forfeits.py - forfeits of abandoned games for Baskin Robbins 31 Game API
+
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+import endpoints
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import ratings
+from models import Game
+from utils import save_game_async
+
+SCAN_URL = '/tasks/forfeits/scan'
+FORFEIT_URL = '/tasks/forfeits/forfeit'
+FORFEIT_QUEUE = 'forfeits'
+# The player to move forfeits a game that has been idle this long
+IDLE_TIME = timedelta(days=float(os.environ.get('FORFEIT_IDLE_DAYS', '7')))
+SCAN_BATCH_SIZE = 1000
+FORFEIT_BATCH_SIZE = 50
+
+
+def start():
+    """Starts a sweep over the games that are idle as of now"""
+    cutoff = int(time.time() - IDLE_TIME.total_seconds())
+    taskqueue.add(url=SCAN_URL,
+                  queue_name=FORFEIT_QUEUE,
+                  params={'cutoff': cutoff, 'cursor': ''})
+
+
+def _cutoff_datetime(cutoff):
+    return datetime.utcfromtimestamp(cutoff)
+
+
+def scan(cutoff, cursor):
+    """Fans one page of idle games out to forfeit tasks and chains the scan
+       of the next page"""
+    query = Game.query(Game.game_over == False,
+                       Game.last_update < _cutoff_datetime(cutoff))
+    game_keys, next_cursor, more = query.fetch_page(
+        SCAN_BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor) if cursor
+        else None, keys_only=True)
+    urlsafe_keys = [key.urlsafe() for key in game_keys]
+    tasks = []
+    for start in range(0, len(urlsafe_keys), FORFEIT_BATCH_SIZE):
+        tasks.append(taskqueue.Task(
+            url=FORFEIT_URL,
+            params={'cutoff': cutoff,
+                    'game_key': urlsafe_keys[start:start +
+                                             FORFEIT_BATCH_SIZE]}))
+    if more and next_cursor:
+        tasks.append(taskqueue.Task(
+            url=SCAN_URL,
+            params={'cutoff': cutoff, 'cursor': next_cursor.urlsafe()}))
+    if tasks:
+        taskqueue.Queue(FORFEIT_QUEUE).add(tasks)
+
+
+def forfeit(cutoff, urlsafe_game_keys):
+    """Forfeits the player to move in each game that is still idle, through
+       Game.quit_game. Each game is committed in its own transaction, all of
+       them concurrently. Returns the number of games forfeited"""
+    cutoff = _cutoff_datetime(cutoff)
+    games = ndb.get_multi([ndb.Key(urlsafe=key) for key in urlsafe_game_keys])
+    pending = []
+    for game in games:
+        if not game or game.game_over or game.last_update >= cutoff:
+            continue
+        results = game.quit_game(game.users[0])
+        pending.append((game, save_game_async(
+            game, results['moves'], results['scores'])))
+
+    forfeited = 0
+    for game, future in pending:
+        try:
+            future.get_result()
+        except endpoints.ConflictException:
+            # Moved since it was read, so it is no longer idle
+            continue
+        except Exception:
+            # Still idle, so the next sweep tries the game again
+            logging.exception('Failed to forfeit %s', game.key)
+            continue
+        forfeited += 1
+    if forfeited:
+        ratings.schedule_apply()
+    return forfeited
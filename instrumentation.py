@@ -0,0 +1,172 @@
+# instrumentation.py - sampled instrumentation for Baskin Robbins 31 Game API
+
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter
+
+from google.appengine.api import apiproxy_stub_map
+from protorpc import messages, protojson
+
+# Fraction of top level calls (requests) that are instrumented. Unsampled
+# calls only pay for one random() call
+SAMPLE_RATE = float(os.environ.get('INSTRUMENTATION_SAMPLE_RATE', '0.01'))
+
+_local = threading.local()
+_aggregate = {}
+_aggregate_lock = threading.Lock()
+_hooked_proxy = None
+
+
+def _rpc_hook(service, call, request, response):
+    """apiproxy pre-call hook, counts RPCs made by the innermost sampled
+       call"""
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1]['rpcs']['%s.%s' % (service, call)] += 1
+
+
+def _ensure_hook():
+    """Registers the RPC hook on the current apiproxy"""
+    global _hooked_proxy
+    proxy = apiproxy_stub_map.apiproxy
+    if proxy is not _hooked_proxy:
+        proxy.GetPreCallHooks().Append('instrumentation', _rpc_hook)
+        _hooked_proxy = proxy
+
+
+def _payload_size(result, args):
+    """Size of an endpoint's JSON response or a handler's response body"""
+    if isinstance(result, messages.Message):
+        return len(protojson.encode_message(result))
+    response = getattr(args[0], 'response', None) if args else None
+    body = getattr(response, 'body', None)
+    return len(body) if body is not None else None
+
+
+def count(name, value=1):
+    """Adds to a named counter on the innermost sampled call, if any"""
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1]['counters'][name] += value
+
+
+def _call_name(func, args):
+    """Name of a call, qualified by class for methods and classmethods"""
+    if args:
+        owner = args[0] if isinstance(args[0], type) else type(args[0])
+        if getattr(owner, func.__name__, None) is not None:
+            return '%s.%s.%s' % (func.__module__, owner.__name__,
+                                 func.__name__)
+    return '%s.%s' % (func.__module__, func.__name__)
+
+
+def instrumented(func):
+    """Records wall time, RPCs by type and payload size for a sampled call.
+       Instrumented calls nested inside a sampled call are reported as spans
+       of the outermost call, which emits one structured log line"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'active', False):
+            if _local.stack is None:
+                # Nested inside an unsampled call
+                return func(*args, **kwargs)
+            return _measure(_call_name(func, args), func, args, kwargs)
+
+        _local.active = True
+        try:
+            if random.random() >= SAMPLE_RATE:
+                _local.stack = None
+                return func(*args, **kwargs)
+            _ensure_hook()
+            _local.stack = []
+            return _measure(_call_name(func, args), func, args, kwargs)
+        finally:
+            _local.active = False
+            _local.stack = None
+    return wrapper
+
+
+def _measure(name, func, args, kwargs):
+    stack = _local.stack
+    record = {'rpcs': Counter(), 'counters': Counter(), 'spans': Counter()}
+    stack.append(record)
+    start = time.time()
+    error = None
+    result = None
+    try:
+        result = func(*args, **kwargs)
+        return result
+    except Exception as e:
+        error = e.__class__.__name__
+        raise
+    finally:
+        elapsed_ms = (time.time() - start) * 1000
+        stack.pop()
+        if stack:
+            parent = stack[-1]
+            parent['rpcs'].update(record['rpcs'])
+            parent['counters'].update(record['counters'])
+            parent['spans'][name] += elapsed_ms
+        else:
+            _emit(name, record, elapsed_ms, error,
+                  _payload_size(result, args))
+
+
+def _emit(name, record, elapsed_ms, error, payload_bytes):
+    """Logs a sampled call and adds it to the in-memory aggregate"""
+    logging.info('instrumentation %s', json.dumps({
+        'name': name,
+        'ms': round(elapsed_ms, 3),
+        'rpcs': record['rpcs'],
+        'counters': record['counters'],
+        'spans': dict((span, round(ms, 3))
+                      for span, ms in record['spans'].items()),
+        'payload_bytes': payload_bytes,
+        'error': error,
+    }, sort_keys=True))
+
+    with _aggregate_lock:
+        stats = _aggregate.setdefault(name, {
+            'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+            'payload_bytes': 0, 'rpcs': Counter(), 'counters': Counter()})
+        stats['count'] += 1
+        stats['errors'] += 1 if error else 0
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        stats['payload_bytes'] += payload_bytes or 0
+        stats['rpcs'].update(record['rpcs'])
+        stats['counters'].update(record['counters'])
+
+
+def snapshot():
+    """Returns this instance's aggregate of sampled calls, with per-call
+       means, as a JSON serializable dict"""
+    with _aggregate_lock:
+        result = {}
+        for name, stats in _aggregate.items():
+            calls = float(stats['count'])
+            result[name] = {
+                'count': stats['count'],
+                'errors': stats['errors'],
+                'mean_ms': round(stats['total_ms'] / calls, 3),
+                'max_ms': round(stats['max_ms'], 3),
+                'mean_payload_bytes': round(stats['payload_bytes'] / calls),
+                'rpcs_per_call': dict(
+                    (rpc, round(total / calls, 3))
+                    for rpc, total in stats['rpcs'].items()),
+                'counters_per_call': dict(
+                    (counter, round(total / calls, 3))
+                    for counter, total in stats['counters'].items()),
+            }
+        return {'sample_rate': SAMPLE_RATE, 'calls': result}
+
+
+def reset():
+    """Clears this instance's aggregate"""
+    with _aggregate_lock:
+        _aggregate.clear()
@@ -0,0 +1,254 @@
+# leaderboard.py - memcache-backed user rankings for Baskin Robbins 31 Game API
+
+import bisect
+import time
+import uuid
+
+from google.appengine.api import memcache, taskqueue
+
+from models import User
+
+# The ranked snapshot is stored as a small index entry plus fixed-size chunks
+# of (-rating, name) entries, so a page or rank lookup only has to fetch the
+# chunks it touches instead of the whole user base.
+SNAPSHOT_KEY = 'leaderboard:snapshot'
+CHUNK_KEY = 'leaderboard:chunk:%s'
+CHUNK_SIZE = 1000
+SNAPSHOT_TTL = 60 * 60 * 24
+UPDATE_RETRIES = 3
+# The snapshot is only ever rebuilt by a task, one at a time, while requests
+# keep reading the stale snapshot
+REBUILD_URL = '/tasks/rebuild_leaderboard'
+REBUILD_QUEUE = 'ratings'
+REBUILD_LOCK_KEY = 'leaderboard:rebuild'
+# Matches the task deadline, so a crashed rebuild doesn't hold the lock
+REBUILD_LOCK_TTL = 10 * 60
+# Requests for a rebuild within the same window share a single task
+REBUILD_WINDOW = 60
+
+
+def _entry(name, rating):
+    """Sort key for a user: highest rating first, ties broken by name"""
+    return (-rating, name)
+
+
+def _new_chunk_key():
+    return CHUNK_KEY % uuid.uuid4().hex
+
+
+def invalidate():
+    """Schedules a rebuild of the snapshot. Reads keep being served from the
+       stale snapshot until the rebuild replaces it"""
+    window = int(time.time()) // REBUILD_WINDOW
+    try:
+        taskqueue.add(url=REBUILD_URL,
+                      queue_name=REBUILD_QUEUE,
+                      name='rebuild-leaderboard-%d' % window)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+
+def _build_snapshot():
+    """Builds the ranked snapshot from a projection query and caches it"""
+    snapshot = {'keys': [], 'firsts': [], 'sizes': []}
+    chunks = {}
+    chunk = []
+
+    def flush():
+        chunk_key = _new_chunk_key()
+        chunks[chunk_key] = chunk
+        snapshot['keys'].append(chunk_key)
+        snapshot['firsts'].append(chunk[0])
+        snapshot['sizes'].append(len(chunk))
+
+    query = User.query().order(-User.rating, User.name)
+    for user in query.iter(projection=[User.name, User.rating],
+                           batch_size=CHUNK_SIZE):
+        chunk.append(_entry(user.name, user.rating))
+        if len(chunk) == CHUNK_SIZE:
+            flush()
+            chunk = []
+    if chunk:
+        flush()
+
+    if not memcache.set_multi(chunks, time=SNAPSHOT_TTL):
+        memcache.set(SNAPSHOT_KEY, snapshot, time=SNAPSHOT_TTL)
+    return snapshot, chunks
+
+
+def rebuild():
+    """Rebuilds the snapshot from a scan of every user. Called by the rebuild
+       task. Returns False without scanning if another rebuild is running"""
+    if not memcache.add(REBUILD_LOCK_KEY, True, time=REBUILD_LOCK_TTL):
+        return False
+    try:
+        _build_snapshot()
+    finally:
+        memcache.delete(REBUILD_LOCK_KEY)
+    return True
+
+
+def _load_snapshot():
+    """Returns the cached snapshot, or None after scheduling a rebuild"""
+    snapshot = memcache.get(SNAPSHOT_KEY)
+    if snapshot is None:
+        invalidate()
+    return snapshot
+
+
+def _load_chunks(snapshot, indexes):
+    """Returns {index: chunk} for the requested chunk indexes, or None after
+       scheduling a rebuild if any chunk has been evicted"""
+    keys = [snapshot['keys'][i] for i in indexes]
+    cached = memcache.get_multi(keys)
+    if len(cached) < len(keys):
+        invalidate()
+        return None
+    return dict(zip(indexes, [cached[k] for k in keys]))
+
+
+def _query_page(offset, limit):
+    """Reads a page straight from the User index while there is no usable
+       snapshot. The cost grows with offset, so this only stands in until
+       the rebuild finishes. total is only known to be past the page"""
+    users = User.query().order(-User.rating, User.name).fetch(
+        limit + 1, offset=offset, projection=[User.name, User.rating])
+    return ([(offset + i + 1, user.name, user.rating)
+             for i, user in enumerate(users[:limit])],
+            offset + len(users))
+
+
+def get_page(offset, limit):
+    """Returns (ranked_entries, total) where ranked_entries is a list of
+       (rank, name, rating) tuples starting at the given offset"""
+    snapshot = _load_snapshot()
+    if snapshot is None:
+        return _query_page(offset, limit)
+    total = sum(snapshot['sizes'])
+    if offset >= total or limit < 1:
+        return [], total
+
+    # Find the chunk containing offset and the chunks needed to fill the page
+    start = 0
+    indexes = []
+    first_offset = None
+    for i, size in enumerate(snapshot['sizes']):
+        if start + size > offset and start < offset + limit:
+            if first_offset is None:
+                first_offset = offset - start
+            indexes.append(i)
+        start += size
+
+    chunks = _load_chunks(snapshot, indexes)
+    if chunks is None:
+        return _query_page(offset, limit)
+    entries = []
+    for i in indexes:
+        entries.extend(chunks[i])
+    entries = entries[first_offset:first_offset + limit]
+    return ([(offset + i + 1, name, -rating)
+             for i, (rating, name) in enumerate(entries)], total)
+
+
+def get_rank(name, rating, neighbours=0):
+    """Returns the ranked entries around the given user, or None if the
+       rankings are being rebuilt. The user's own entry is surrounded by up
+       to `neighbours` entries on each side. A user missing from a stale
+       snapshot is ranked where their current rating would place them"""
+    entry = _entry(name, rating)
+    snapshot = _load_snapshot()
+    if not snapshot or not snapshot['keys']:
+        return None
+    index = max(0, bisect.bisect_right(snapshot['firsts'], entry) - 1)
+    chunks = _load_chunks(snapshot, [index])
+    if chunks is None:
+        return None
+    chunk = chunks[index]
+    position = bisect.bisect_left(chunk, entry)
+    offset = sum(snapshot['sizes'][:index]) + position
+    if position < len(chunk) and chunk[position] == entry:
+        start = max(0, offset - neighbours)
+        entries, _ = get_page(start, offset - start + neighbours + 1)
+        return entries
+    # The snapshot may still hold the user under an old rating
+    start = max(0, offset - neighbours)
+    above = get_page(start, offset - start)[0] if offset > start else []
+    below = get_page(offset, neighbours)[0] if neighbours else []
+    return ([ranked for ranked in above if ranked[1] != name] +
+            [(offset + 1, name, rating)] +
+            [(rank + 1, other, other_rating)
+             for rank, other, other_rating in below if other != name])
+
+
+def _apply_changes(snapshot, changes):
+    """Returns a copy of snapshot with changes applied, writing any modified
+       chunks under new keys. Returns None if the snapshot needs a rebuild"""
+    keys = list(snapshot['keys'])
+    firsts = list(snapshot['firsts'])
+    sizes = list(snapshot['sizes'])
+    chunks = {}
+
+    def chunk_for(entry):
+        index = max(0, bisect.bisect_right(firsts, entry) - 1)
+        if index not in chunks:
+            chunk = memcache.get(keys[index])
+            if chunk is None:
+                return index, None
+            chunks[index] = list(chunk)
+        return index, chunks[index]
+
+    for name, old_rating, new_rating in changes:
+        if old_rating is not None:
+            old = _entry(name, old_rating)
+            index, chunk = chunk_for(old)
+            if chunk is None:
+                return None
+            position = bisect.bisect_left(chunk, old)
+            if position == len(chunk) or chunk[position] != old:
+                return None
+            del chunk[position]
+            if not chunk:
+                return None
+            firsts[index] = chunk[0]
+
+        new = _entry(name, new_rating)
+        index, chunk = chunk_for(new)
+        if chunk is None:
+            return None
+        bisect.insort(chunk, new)
+        if len(chunk) > 2 * CHUNK_SIZE:
+            return None
+        firsts[index] = chunk[0]
+
+    new_chunks = {}
+    for index, chunk in chunks.items():
+        keys[index] = _new_chunk_key()
+        sizes[index] = len(chunk)
+        new_chunks[keys[index]] = chunk
+    if memcache.set_multi(new_chunks, time=SNAPSHOT_TTL):
+        return None
+    return {'keys': keys, 'firsts': firsts, 'sizes': sizes}
+
+
+def update_ratings(changes):
+    """Incrementally applies rating changes to the cached snapshot.
+       changes is a list of (name, old_rating, new_rating) tuples; use an
+       old_rating of None for newly created users"""
+    if not changes:
+        return
+    client = memcache.Client()
+    for attempt in range(UPDATE_RETRIES):
+        snapshot = client.gets(SNAPSHOT_KEY)
+        if snapshot is None:
+            # Nothing cached, the rebuild scheduled by the next read
+            # includes these changes
+            return
+        if not snapshot['keys']:
+            break
+        updated = _apply_changes(snapshot, changes)
+        if updated is None:
+            break
+        if client.cas(SNAPSHOT_KEY, updated, time=SNAPSHOT_TTL):
+            return
+    invalidate()
@@ -0,0 +1,153 @@
+# lobby.py - matchmaking lobby for Baskin Robbins 31 Game API
+
+import json
+import logging
+import time
+import uuid
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Game, LobbyTicket
+
+MATCH_URL = '/tasks/match_lobby'
+# Joins are pull tasks tagged with their settings, so joining never writes
+# to the datastore and the matcher leases them in bulk
+LOBBY_QUEUE = 'lobby'
+MATCHER_QUEUE = 'matcher'
+# Joins within the same window share a single matcher task
+MATCH_WINDOW = 2
+# Unmatched joins are left leased, and come back for the next run once
+# their lease lapses
+LEASE_SECONDS = 10
+LEASE_BATCH_SIZE = 1000
+# Settings tags leased by one matcher run
+MAX_TAGS_PER_RUN = 20
+# Unmatched joins older than this are dropped
+JOIN_TIMEOUT = 10 * 60
+MAX_PLAYERS = 8
+
+
+def settings_tag(max_int, max_increment, players):
+    return '%d:%d:%d' % (max_int, max_increment, players)
+
+
+def _parse_tag(tag):
+    return [int(value) for value in tag.split(':')]
+
+
+def join(username, max_int, max_increment, players):
+    """Adds a user to the lobby for games with these settings and schedules
+       the matcher. Returns the ticket to check for the user's game"""
+    ticket = uuid.uuid4().hex
+    taskqueue.Queue(LOBBY_QUEUE).add(taskqueue.Task(
+        payload=json.dumps({'user': username, 'ticket': ticket,
+                            'joined': time.time()}),
+        method='PULL',
+        tag=settings_tag(max_int, max_increment, players)))
+    schedule_match()
+    return ticket
+
+
+def schedule_match():
+    """Enqueues a matcher task for the current batch window"""
+    window = int(time.time()) // MATCH_WINDOW
+    try:
+        taskqueue.add(url=MATCH_URL,
+                      queue_name=MATCHER_QUEUE,
+                      name='match-lobby-%d' % window,
+                      countdown=MATCH_WINDOW)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+
+def _group(tasks, players):
+    """Splits joins, oldest first, into games of distinct users. Returns
+       (games, leftover) where each game is a list of (task, join)"""
+    games = []
+    waiting = []
+    for task, joined in tasks:
+        for game in waiting:
+            if all(other['user'] != joined['user'] for t, other in game):
+                game.append((task, joined))
+                break
+        else:
+            game = [(task, joined)]
+            waiting.append(game)
+        if len(game) == players:
+            waiting.remove(game)
+            games.append(game)
+    leftover = [entry for game in waiting for entry in game]
+    return games, leftover
+
+
+def _match_tag(queue, tag, tasks):
+    """Creates a game for every full group of one settings tag's leased
+       joins, and deletes the joins that were matched or expired. The rest
+       keep their lease. Returns True if any join was matched or expired"""
+    entries = []
+    expired = []
+    now = time.time()
+    for task in tasks:
+        joined = json.loads(task.payload)
+        if now - joined['joined'] > JOIN_TIMEOUT:
+            expired.append((task, joined))
+        else:
+            entries.append((task, joined))
+
+    # A ticket exists once its join was matched, which guards against a
+    # join being leased again after its task failed to be deleted
+    tickets = ndb.get_multi([ndb.Key(LobbyTicket, joined['ticket'])
+                             for task, joined in entries])
+    matched_tickets = set(ticket.key.id() for ticket in tickets if ticket)
+
+    done = [task for task, joined in expired]
+    entities = [LobbyTicket(id=joined['ticket'], expired=True)
+                for task, joined in expired]
+    done.extend(task for task, joined in entries
+                if joined['ticket'] in matched_tickets)
+    entries = [(task, joined) for task, joined in entries
+               if joined['ticket'] not in matched_tickets]
+    max_int, max_increment, players = _parse_tag(tag)
+    groups, leftover = _group(entries, players)
+
+    if groups:
+        # Tickets point at their game, so the games' ids are allocated
+        # up front to save them all in one put_multi
+        first, last = Game.allocate_ids(len(groups))
+        for game_id, group in zip(range(first, last + 1), groups):
+            game = Game.new_game(
+                players=[joined['user'] for task, joined in group],
+                current_int=0, max_int=max_int,
+                max_increment=max_increment, put=False)
+            game.key = ndb.Key(Game, game_id)
+            entities.append(game)
+            for task, joined in group:
+                entities.append(LobbyTicket(id=joined['ticket'],
+                                            game_key=game.key))
+                done.append(task)
+
+    ndb.put_multi(entities)
+    if done:
+        queue.delete_tasks(done)
+    if expired:
+        logging.info('Dropped %d expired lobby joins', len(expired))
+    return bool(done)
+
+
+def match():
+    """Leases joins one settings tag at a time, the tag of the oldest
+       waiting join first, and creates a game for every full group. Joins
+       that can't be matched yet keep their lease until it lapses, so the
+       next lease moves on to newer tags instead of starving them. Returns
+       True if there may be more joins waiting"""
+    queue = taskqueue.Queue(LOBBY_QUEUE)
+    progress = False
+    for attempt in range(MAX_TAGS_PER_RUN):
+        tasks = queue.lease_tasks_by_tag(LEASE_SECONDS, LEASE_BATCH_SIZE)
+        if not tasks:
+            return False
+        progress = _match_tag(queue, tasks[0].tag, tasks) or progress
+    # Only worth another run right away if this one matched anything
+    return progress
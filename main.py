@@ -1,39 +1,280 @@
-# main.py - handles SendReminderEmail cronjob for Baskin Robbins 31 Game API
+# main.py - cronjobs and task queue workers for Baskin Robbins 31 Game API
+import json
+import logging
+
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import archive
+import forfeits
+import instrumentation
+import leaderboard
+import lobby
+import ratings
+import reminders
+from instrumentation import instrumented
+from models import User, Game, Score
+from utils import uncache_game
+
+MIGRATION_BATCH_SIZE = 500
+MIGRATE_USER_INDEX_URL = '/tasks/migrate_user_index'
+MIGRATE_SCORES_URL = '/tasks/migrate_scores'
+PACK_MOVE_HISTORY_URL = '/tasks/pack_move_history'
+BACKFILL_GAME_RESULTS_URL = '/tasks/backfill_game_results'
+
+
+class CursorTask(webapp2.RequestHandler):
+    """Processes a query a page at a time, chaining a task at url for the
+    next page. Subclasses implement run(cursor), returning the cursor of
+    the next page or None once done"""
+    url = None
+    queue_name = 'default'
+
+    @instrumented
+    def get(self):
+        """Start from the first page, from a cron job or an admin"""
+        self._run(None)
 
-from datetime import datetime, timedelta
-from models import User, Game
+    @instrumented
+    def post(self):
+        """Process the page at the task's cursor"""
+        self._run(Cursor(urlsafe=self.request.get('cursor')))
+
+    def _run(self, cursor):
+        next_cursor = self.run(cursor)
+        if next_cursor:
+            taskqueue.add(url=self.url,
+                          queue_name=self.queue_name,
+                          params={'cursor': next_cursor.urlsafe()})
 
 
 class SendReminderEmail(webapp2.RequestHandler):
+    @instrumented
     def get(self):
         """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
-
-        app_id = app_identity.get_application_id()
-
-        onehourago = datetime.now() - timedelta(hours=1)
-
-        old_games = Game.query(Game.last_update < onehourago).fetch()
-        users_to_email = []
-        for game in old_games:
-            users_to_email.append(game.users[0])
-        users_to_email = set(users_to_email)
-        if users_to_email:
-            users_to_email = User.query(User.name.IN(users_to_email)).fetch()
-        for user in users_to_email:
-            subject = 'This is a reminder!'
-            body = """\
-                Hello, you have one or more pending Baskin Robbins 31 games!\
-            """
-            # This will send test emails, the arguments to send_mail are:
-            # from, to, subject, body
-            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                           user.email,
-                           subject,
-                           body)
+        Called every hour using a cron job. Starts the scan for this hour's
+        window, or resumes it from its checkpoint if it was interrupted"""
+        reminders.start(reminders.current_window())
+
+
+class ScanReminders(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Fan out one page of idle games to a send task"""
+        reminders.scan(int(self.request.get('window')),
+                       self.request.get('cursor'))
+
+
+class SendReminders(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Send reminders for a batch of idle games"""
+        reminders.send(int(self.request.get('window')),
+                       self.request.get_all('game_key'))
+
+
+class ForfeitIdleGames(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Forfeit games left idle for longer than forfeits.IDLE_TIME.
+        Called every hour by a cron job"""
+        forfeits.start()
+
+
+class ScanForfeits(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Fan out one page of idle games to forfeit tasks"""
+        forfeits.scan(int(self.request.get('cutoff')),
+                      self.request.get('cursor'))
+
+
+class ForfeitGames(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Forfeit a batch of idle games"""
+        forfeits.forfeit(int(self.request.get('cutoff')),
+                         self.request.get_all('game_key'))
+
+
+class ApplyRatings(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Apply pending rating changes. Called every minute by a cron job to
+        pick up any games whose aggregation task was never enqueued"""
+        self.post()
+
+    @instrumented
+    def post(self):
+        """Apply a batch of pending rating changes, chaining another task
+        while more remain"""
+        if ratings.apply_pending():
+            taskqueue.add(url=ratings.APPLY_URL,
+                          queue_name=ratings.RATINGS_QUEUE)
+
+
+class ReconcileRatings(CursorTask):
+    """Rebuild every User's rating from their Score entities, a page of
+    users at a time. Called daily by a cron job"""
+    url = ratings.RECONCILE_URL
+    queue_name = ratings.RATINGS_QUEUE
+
+    def run(self, cursor):
+        return ratings.reconcile(cursor)
+
+
+class RebuildLeaderboard(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Rebuild the rankings snapshot from every User. Fails while another
+        rebuild is running, so the task is retried once it has finished"""
+        if not leaderboard.rebuild():
+            self.response.set_status(409)
+
+
+class MigrateScores(CursorTask):
+    """Move existing Scores from their User's entity group into their
+    Game's. Run once by an admin after deploying Score.user"""
+    url = MIGRATE_SCORES_URL
+
+    def run(self, cursor):
+        score_keys, next_cursor, more = Score.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        for score_key in score_keys:
+            if score_key.parent().kind() == 'User':
+                Score.migrate(score_key)
+        return next_cursor if more else None
+
+
+class ArchiveGames(CursorTask):
+    """Move games that finished more than a day ago out of the Game kind.
+    Called daily by a cron job"""
+    url = archive.ARCHIVE_URL
+
+    def run(self, cursor):
+        return archive.archive(cursor)
+
+
+class MatchLobby(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Match waiting lobby joins. Called every minute by a cron job to
+        pick up joins left over by earlier matcher tasks"""
+        self.post()
+
+    @instrumented
+    def post(self):
+        """Create games for a batch of lobby joins, chaining another task
+        while more remain"""
+        if lobby.match():
+            taskqueue.add(url=lobby.MATCH_URL,
+                          queue_name=lobby.MATCHER_QUEUE)
+
+
+class MigrateUserIndex(CursorTask):
+    """Create username and email index entities for existing Users. Run
+    once by an admin after deploying the index models"""
+    url = MIGRATE_USER_INDEX_URL
+
+    def run(self, cursor):
+        users, next_cursor, more = User.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        entities = [entity for user in users
+                    for entity in user.index_entities()]
+        existing = ndb.get_multi([entity.key for entity in entities])
+        # Index entities are only ever inserted, as a lookup or a new user
+        # may have written one since the page was read
+        futures = [type(entity).get_or_insert_async(entity.key.id(),
+                                                    user=entity.user)
+                   if not index else None
+                   for entity, index in zip(entities, existing)]
+        for entity, index, future in zip(entities, existing, futures):
+            if future:
+                index = future.get_result()
+            if index.user != entity.user:
+                logging.warning('%s %s is indexed to %s, not %s',
+                                entity.key.kind(), entity.key.id(),
+                                index.user, entity.user)
+        return next_cursor if more else None
+
+
+class PackMoveHistory(CursorTask):
+    """Pack the MoveRecords of existing games into their move_log. Run once
+    by an admin"""
+    url = PACK_MOVE_HISTORY_URL
+
+    def run(self, cursor):
+        game_keys, next_cursor, more = Game.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        for game_key in game_keys:
+            if Game.pack_history(game_key):
+                uncache_game(game_key)
+        return next_cursor if more else None
+
+
+class BackfillGameResults(CursorTask):
+    """Store winners and loser on games that finished before they were
+    recorded, from their Score entities. Run once by an admin"""
+    url = BACKFILL_GAME_RESULTS_URL
+
+    def run(self, cursor):
+        games, next_cursor, more = Game.query(
+            Game.game_over == True).fetch_page(
+                MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        updated = []
+        for game in games:
+            if game.loser:
+                continue
+            scores = Score.query(Score.game_key == game.key).fetch()
+            users = ndb.get_multi([score.user_key for score in scores])
+            if not all(users):
+                # Without the loser the game would be backfilled again on
+                # every run, so leave it to be fixed by hand
+                logging.warning('Skipping game %s with missing users',
+                                game.key.urlsafe())
+                continue
+            results = zip(scores, users)
+            game.winners = [user.name for score, user in results
+                            if score.points >= 0]
+            game.loser = next((user.name for score, user in results
+                               if score.points < 0), None)
+            updated.append(game)
+        ndb.put_multi(updated)
+        for game in updated:
+            uncache_game(game.key)
+        return next_cursor if more else None
+
+
+class Metrics(webapp2.RequestHandler):
+    def get(self):
+        """Return this instance's aggregate of sampled instrumentation as
+        JSON. Pass reset=1 to clear it afterwards"""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(instrumentation.snapshot()))
+        if self.request.get('reset'):
+            instrumentation.reset()
 
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/crons/apply_ratings', ApplyRatings),
+    ('/crons/reconcile_ratings', ReconcileRatings),
+    (ratings.APPLY_URL, ApplyRatings),
+    (ratings.RECONCILE_URL, ReconcileRatings),
+    (leaderboard.REBUILD_URL, RebuildLeaderboard),
+    ('/crons/archive_games', ArchiveGames),
+    (archive.ARCHIVE_URL, ArchiveGames),
+    ('/crons/match_lobby', MatchLobby),
+    (lobby.MATCH_URL, MatchLobby),
+    (MIGRATE_USER_INDEX_URL, MigrateUserIndex),
+    (MIGRATE_SCORES_URL, MigrateScores),
+    (PACK_MOVE_HISTORY_URL, PackMoveHistory),
+    (BACKFILL_GAME_RESULTS_URL, BackfillGameResults),
+    (reminders.SCAN_URL, ScanReminders),
+    (reminders.SEND_URL, SendReminders),
+    ('/crons/forfeit_idle_games', ForfeitIdleGames),
+    (forfeits.SCAN_URL, ScanForfeits),
+    (forfeits.FORFEIT_URL, ForfeitGames),
+    ('/admin/metrics', Metrics),
 ], debug=True)
@@ -1,16 +1,143 @@
 # models.py - models for Baskin Robbins 31 Game API
 
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import ndb
 from protorpc import messages
 
+import struct
+from datetime import datetime, timedelta
 from random import shuffle
 
+import engine
+import solver
+from instrumentation import instrumented
+
+# Usernames of server-side bot players, which real users can't register
+BOT_PREFIX = 'bot:'
+BOT_NAME = BOT_PREFIX + '%d'
+
+# Packed move_log entry: player index, move value (0 for quit) and seconds
+# since the game was created
+MOVE_LOG_FORMAT = struct.Struct('<HiI')
+QUIT_MOVE = 'quit'
+
 
 class User(ndb.Model):
     """User profile"""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
     rating = ndb.FloatProperty(default=0)
+    bot = ndb.BooleanProperty(default=False)
+
+    @classmethod
+    def create(cls, name, email, bot=False):
+        """Creates and returns a new user along with its username and email
+           index entities. Raises ValueError if either is already taken"""
+        if not name:
+            raise ValueError("Username must not be empty.")
+        if not bot and name.startswith(BOT_PREFIX):
+            raise ValueError(
+                "Usernames starting with %s are reserved." % BOT_PREFIX)
+        # Users that aren't indexed yet are indexed first, so the checks in
+        # the transaction cover them too
+        futures = [cls._get_by_index_async(UserName, [name]),
+                   cls._get_by_index_async(UserEmail, [email])]
+        for future in futures:
+            future.get_result()
+        return cls._create(name, email, bot)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _create(cls, name, email, bot):
+        keys = [_index_key(UserName, name), _index_key(UserEmail, email)]
+        indexes = ndb.get_multi([key for key in keys if key])
+        if indexes[0]:
+            raise ValueError("A User with that name already exists.")
+        if len(indexes) > 1 and indexes[1]:
+            raise ValueError(
+                "A User with that Google plus account already exists.")
+        user = cls(name=name, email=email, bot=bot)
+        user.put()
+        ndb.put_multi(user.index_entities())
+        return user
+
+    @classmethod
+    def get_bots(cls, count):
+        """Returns count bot users, creating any that don't exist yet"""
+        names = [BOT_NAME % (i + 1) for i in range(count)]
+        bots = cls.get_by_names_async(names).get_result()
+        for i, name in enumerate(names):
+            if not bots[i]:
+                try:
+                    bots[i] = cls.create(name, None, bot=True)
+                except ValueError:
+                    # Created by a concurrent request
+                    bots[i] = cls.get_by_name(name)
+        return bots
+
+    @classmethod
+    @ndb.tasklet
+    def _get_by_index_async(cls, index_kind, values):
+        """Resolves index entities to users with two batched key gets. Users
+           that aren't indexed yet are found by query instead"""
+        keys = [_index_key(index_kind, value) for value in values]
+        indexes = yield ndb.get_multi_async([key for key in keys if key])
+        indexes = iter(indexes)
+        user_keys = [next(indexes) if key else None for key in keys]
+        user_keys = [index.user if index else None for index in user_keys]
+        missing = [value for value, key, user_key
+                   in zip(values, keys, user_keys) if key and not user_key]
+        if missing:
+            found = yield cls._index_missing_async(index_kind, missing)
+            user_keys = [user_key or found.get(value)
+                         for value, user_key in zip(values, user_keys)]
+        users = yield ndb.get_multi_async([key for key in user_keys if key])
+        users = iter(users)
+        raise ndb.Return([next(users) if key else None for key in user_keys])
+
+    @classmethod
+    @ndb.tasklet
+    def _index_missing_async(cls, index_kind, values):
+        """Finds users created before the index entities existed, until the
+           /tasks/migrate_user_index migration has run, and writes their
+           missing index entities. Returns {value: user key}"""
+        prop = cls.name if index_kind is UserName else cls.email
+        results = yield [cls.query(prop == value).fetch_async(
+            1, keys_only=True) for value in values]
+        found = [(value, user_keys[0])
+                 for value, user_keys in zip(values, results) if user_keys]
+        # Inserted only if still missing, so an index entity written
+        # meanwhile by a new user or the migration is never overwritten
+        indexes = yield [index_kind.get_or_insert_async(value, user=user_key)
+                         for value, user_key in found]
+        raise ndb.Return(dict((value, index.user) for (value, user_key), index
+                              in zip(found, indexes)))
+
+    @classmethod
+    def get_by_names_async(cls, names):
+        """Looks up users by unique username in one batch. Returns a future for
+           a list of users in the same order as names, None for unknown
+           names"""
+        return cls._get_by_index_async(UserName, names)
+
+    @classmethod
+    @instrumented
+    def get_by_name(cls, name):
+        """Returns the user with the given username, or None"""
+        return cls.get_by_names_async([name]).get_result()[0]
+
+    @classmethod
+    @instrumented
+    def get_by_email(cls, email):
+        """Returns the user with the given gplus email, or None"""
+        return cls._get_by_index_async(UserEmail, [email]).get_result()[0]
+
+    def index_entities(self):
+        """Returns the username and email index entities for this user"""
+        entities = [UserName(id=self.name, user=self.key)]
+        if self.email:
+            entities.append(UserEmail(id=self.email, user=self.key))
+        return entities
 
     def to_form(self, show_email=False):
         """Returns a UserForm representation of the User"""
@@ -22,66 +149,190 @@ class User(ndb.Model):
         return form
 
 
+def _index_key(index_kind, value):
+    """Returns the key of the index entity for a value, or None if empty"""
+    return ndb.Key(index_kind, value) if value else None
+
+
+class UserName(ndb.Model):
+    """Unique username index, keyed by username. Looking users up by key
+       is strongly consistent and served from ndb's caches"""
+    user = ndb.KeyProperty(kind=User, required=True, indexed=False)
+
+
+class UserEmail(ndb.Model):
+    """Unique gplus email index, keyed by email"""
+    user = ndb.KeyProperty(kind=User, required=True, indexed=False)
+
+
 class UserForm(messages.Message):
     """UserForm for outbound User profile"""
     name = messages.StringField(1, required=True)
     email = messages.StringField(2)
     rating = messages.FloatField(3)
+    rank = messages.IntegerField(4)
 
 
 class UserForms(messages.Message):
     """Return multiple UserForms"""
     users = messages.MessageField(UserForm, 1, repeated=True)
+    next_offset = messages.IntegerField(2)
 
 
 class Game(ndb.Model):
     """Game object"""
+    # Games are cached explicitly (write-through) by utils.cache_game
+    _use_memcache = False
+
     current_int = ndb.IntegerProperty(required=True, default=0)
     max_int = ndb.IntegerProperty(required=True, default=31)
     max_increment = ndb.IntegerProperty(required=True, default=3)
     game_over = ndb.BooleanProperty(required=True, default=False)
     users = ndb.StringProperty(repeated=True)
+    winners = ndb.StringProperty(repeated=True)
+    loser = ndb.StringProperty()
+    # Turn order at creation, used to index players in move_log
+    players = ndb.StringProperty(repeated=True, indexed=False)
+    # Players whose moves are made by the server using the solver
+    bots = ndb.StringProperty(repeated=True, indexed=False)
+    compact_history = ndb.BooleanProperty(default=False, indexed=False)
+    move_log = ndb.BlobProperty(default='')
+    move_count = ndb.IntegerProperty(default=0)
+    version = ndb.IntegerProperty(default=0, indexed=False)
     created = ndb.DateTimeProperty(auto_now_add=True)
     last_update = ndb.DateTimeProperty(auto_now=True)
 
     @classmethod
-    def new_game(cls, players, current_int, max_int, max_increment):
-        """Creates and returns a new game"""
-        if len(players) < 2:
-            raise ValueError("You must specify at least one other player")
-        if len(players) != len(set(players)):
-            raise ValueError("You must only specify unique players")
-        if max_increment < 2:
-            raise ValueError("max_increment must be at least 2")
-        if max_int <= current_int:
-            raise ValueError(
-                "Starting value must be smaller than ending value")
-
+    @instrumented
+    def new_game(cls, players, current_int, max_int, max_increment,
+                 compact_history=True, bots=(), put=True):
+        """Creates and returns a new game. With compact_history, moves are
+           packed into the game's move_log instead of MoveRecord entities.
+           bots lists the players whose moves are made by the server. With
+           put=False the caller saves the game, e.g. in a batch"""
+        engine.check_settings(players, current_int, max_int, max_increment)
         shuffle(players)
         game = Game(current_int=current_int,
                     max_int=max_int,
                     max_increment=max_increment,
                     game_over=False,
-                    users=players)
+                    users=players,
+                    players=list(players),
+                    compact_history=(compact_history and
+                                     len(players) <= 0xffff),
+                    bots=list(bots))
+        if put:
+            game.put()
+        return game
+
+    @classmethod
+    @ndb.transactional
+    def pack_history(cls, game_key):
+        """Packs an existing game's MoveRecords into its move_log and deletes
+           them. Returns the converted game, or None if there was nothing to
+           do"""
+        game = game_key.get()
+        if not game or game.compact_history:
+            return None
+        moves = MoveRecord.query(ancestor=game_key).order(
+            MoveRecord.datetime).fetch()
+        game._pack_records(moves)
+        # Invalidates cached copies and moves validated against them
+        game.version += 1
         game.put()
+        ndb.delete_multi([move.key for move in moves])
         return game
 
-    def make_move(self, move_value):
-        """Implements a move and return entities for datastore transaction"""
-        self.current_int += move_value
-        move = MoveRecord.new_move(self, str(move_value))
-
-        if self.current_int >= self.max_int:
-            moveResultsToSave = self.end_game()
-            message = "Game Over! %s is the loser." % (self.users[0])
-        else:
-            self.users.append(self.users.pop(0))
-            message = "Move successful!"
-            moveResultsToSave = {}
+    def _pack_records(self, moves):
+        """Packs MoveRecords, oldest first, into the game's move_log"""
+        if not self.players:
+            self.players = sorted(set(self.users))
+        self.move_log = ''.join(
+            self._pack_move(move.username, move.move, move.datetime)
+            for move in moves)
+        self.move_count = len(moves)
+        self.compact_history = True
+
+    def _pack_move(self, username, move, when):
+        delta = max(0, int((when - self.created).total_seconds()))
+        value = 0 if move == QUIT_MOVE else int(move)
+        return MOVE_LOG_FORMAT.pack(self.players.index(username), value, delta)
+
+    def record_move(self, username, move):
+        """Records a move by username. Returns a MoveRecord entity to save, or
+           None if the move was packed into the game's move_log"""
+        if not self.compact_history:
+            return MoveRecord.new_move(self, username, move)
+        self.move_count += 1
+        self.move_log += self._pack_move(username, move, datetime.utcnow())
+        return None
+
+    @instrumented
+    def history(self):
+        """Returns the game's moves as MoveRecords, oldest first"""
+        if not self.compact_history:
+            return MoveRecord.query(ancestor=self.key).order(
+                MoveRecord.datetime).fetch()
+        moves = []
+        for offset in range(0, len(self.move_log), MOVE_LOG_FORMAT.size):
+            player, value, delta = MOVE_LOG_FORMAT.unpack_from(
+                self.move_log, offset)
+            moves.append(MoveRecord(
+                username=self.players[player],
+                move=str(value) if value else QUIT_MOVE,
+                datetime=self.created + timedelta(seconds=delta)))
+        return moves
+
+    def state(self):
+        """Returns an engine.GameState copy of the game"""
+        return engine.GameState(self.current_int, self.max_int,
+                                self.max_increment, self.users,
+                                self.game_over)
+
+    def _apply_effects(self, state, effects, moveResultsToSave):
+        """Copies an engine state back into the game and adds the entities
+           for its effects to moveResultsToSave"""
+        self.current_int = state.current_int
+        self.users = state.users
+        for effect in effects:
+            if isinstance(effect, engine.Moved):
+                move = QUIT_MOVE if effect.value is None else str(effect.value)
+                moveResultsToSave['moves'].append(
+                    self.record_move(effect.player, move))
+            else:
+                moveResultsToSave.update(self.end_game(effect))
+
+    def _apply_move(self, move_value, moveResultsToSave):
+        """Applies a move by the current player, adding the entities it
+           creates to moveResultsToSave. Returns a message for the move"""
+        state = self.state()
+        effects = engine.apply_move(state, move_value)
+        self._apply_effects(state, effects, moveResultsToSave)
+        if self.game_over:
+            return "Game Over! %s is the loser." % self.loser
+        return "Move successful!"
+
+    def play_bots(self, moveResultsToSave):
+        """Makes the solver's move for each bot player whose turn it is.
+           Returns messages describing the moves"""
+        messages = []
+        while not self.game_over and self.users[0] in self.bots:
+            hint = solver.best_move(self.current_int, self.max_int,
+                                    self.max_increment, len(self.users))
+            messages.append("%s added %d." % (self.users[0], hint.value))
+            message = self._apply_move(hint.value, moveResultsToSave)
+            if self.game_over:
+                messages.append(message)
+        return messages
 
+    def make_move(self, move_value):
+        """Implements a move, followed by any bot players' moves, and return
+           entities for datastore transaction"""
+        moveResultsToSave = {'moves': []}
+        message = self._apply_move(move_value, moveResultsToSave)
+        messages = [message] + self.play_bots(moveResultsToSave)
         moveResultsToSave['game'] = self
-        moveResultsToSave['move'] = move
-        return moveResultsToSave, message
+        return moveResultsToSave, ' '.join(messages)
 
     def to_form(self, message=None):
         """Return a GameForm representation of the Game"""
@@ -95,35 +346,61 @@ class Game(ndb.Model):
         form.message = message
         form.created = str(self.created)
         form.last_update = str(self.last_update)
+        form.version = self.version
+        return form
+
+    def to_summary_form(self, game_over=None):
+        """Return a GameSummaryForm from a projection of the Game. game_over
+           must be given when it was not part of the projection"""
+        form = GameSummaryForm()
+        form.urlsafe_game_key = self.key.urlsafe()
+        form.current_int = self.current_int
+        form.max_int = self.max_int
+        form.game_over = self.game_over if game_over is None else game_over
+        form.created = str(self.created)
+        form.last_update = str(self.last_update)
         return form
 
-    def end_game(self, loserindex=0):
-        """Ends the game and creates score entities for all players. Returns score and
-           player entities for datastore transaction"""
+    def score_forms(self):
+        """Returns ScoreForms for a finished game from its stored winners and
+           loser, without reading its Score entities"""
+        urlsafe_key = self.key.urlsafe()
+        winner_score = 1.0 / len(self.winners)
+        forms = [ScoreForm(points=winner_score, game_key=urlsafe_key,
+                           username=winner) for winner in self.winners]
+        forms.append(ScoreForm(points=engine.LOSER_POINTS,
+                               game_key=urlsafe_key,
+                               username=self.loser))
+        return forms
+
+    @instrumented
+    def end_game(self, ended):
+        """Ends the game from an engine.Ended effect and creates score entities
+           for all players. Returns score entities for datastore transaction.
+           Ratings are updated later from the scores by the ratings pipeline"""
         self.game_over = True
-        loser = self.users[loserindex]
-        winners = self.users[:loserindex] + self.users[loserindex + 1:]
-        winner_score = 1.0 / len(winners)
-        winners = User.query(User.name.IN(winners)).fetch()
+        self.loser = ended.loser
+        self.winners = ended.winners
+        players = User.get_by_names_async(
+            ended.winners + [ended.loser]).get_result()
         scores = []
-        for user in winners:
-            user.rating += winner_score
-            score_id = Score.allocate_ids(size=1, parent=user.key)[0]
-            score_key = ndb.Key(Score, score_id, parent=user.key)
-            score = Score(points=winner_score, game_key=self.key,
-                          key=score_key)
+        # A player whose User can't be found has no rating to score against
+        for user in players[:-1]:
+            if not user:
+                continue
+            score = Score(points=ended.winner_points, game_key=self.key,
+                          username=user.name, user=user.key,
+                          key=Score.key_for(self.key, user.key))
             scores.append(score)
 
-        loser = User.query(User.name == loser).get()
-        loser.rating -= 1
-        score_id = Score.allocate_ids(size=1, parent=loser.key)[0]
-        score_key = ndb.Key(Score, score_id, parent=loser.key)
-        score = Score(points=-1, game_key=self.key, key=score_key)
-        scores.append(score)
+        loser = players[-1]
+        if loser:
+            score = Score(points=engine.LOSER_POINTS, game_key=self.key,
+                          username=loser.name, user=loser.key,
+                          key=Score.key_for(self.key, loser.key))
+            scores.append(score)
 
         gameResultsToSave = {
-            'winners': winners,
-            'loser': loser,
             'scores': scores
         }
         return gameResultsToSave
@@ -131,16 +408,44 @@ class Game(ndb.Model):
     def quit_game(self, loser_name):
         """Ends the game with the quitting player as the loser. Return entities for
            datastore transaction"""
-        move = MoveRecord.new_move(self, 'quit')
-
-        gameResultsToSave = self.end_game(
-            loserindex=self.users.index(loser_name))
+        gameResultsToSave = {'moves': []}
+        state = self.state()
+        effects = engine.quit_game(state, loser_name)
+        self._apply_effects(state, effects, gameResultsToSave)
         gameResultsToSave['game'] = self
-        gameResultsToSave['move'] = move
 
         return gameResultsToSave
 
 
+class ArchivedGame(ndb.Model):
+    """Finished game moved out of the Game kind by the archiver, keyed by the
+       game's id. Only the properties get_user_games filters on are indexed,
+       the rest of the game is packed into data"""
+    users = ndb.StringProperty(repeated=True)
+    winners = ndb.StringProperty(repeated=True)
+    loser = ndb.StringProperty()
+    created = ndb.DateTimeProperty()
+    data = ndb.BlobProperty(compressed=True)
+
+    @classmethod
+    def key_for(cls, game_key):
+        return ndb.Key(cls, game_key.id())
+
+    @classmethod
+    def from_game(cls, game):
+        """Returns the archive entity for a finished compact_history game"""
+        return cls(key=cls.key_for(game.key),
+                   users=game.users,
+                   winners=game.winners,
+                   loser=game.loser,
+                   created=game.created,
+                   data=game._to_pb().Encode())
+
+    def to_game(self):
+        """Returns the archived Game, with its original key"""
+        return Game._from_pb(entity_pb.EntityProto(self.data))
+
+
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
     current_int = messages.IntegerField(1, variant=messages.Variant.INT32)
@@ -152,11 +457,33 @@ class GameForm(messages.Message):
     message = messages.StringField(7)
     created = messages.StringField(8)
     last_update = messages.StringField(9)
+    version = messages.IntegerField(10)
+    not_modified = messages.BooleanField(11)
 
 
-class GameForms(messages.Message):
-    """Return multiple GameForms"""
-    games = messages.MessageField(GameForm, 1, repeated=True)
+class GameStatus(messages.Enum):
+    """Filters for a user's games"""
+    ALL = 1
+    ACTIVE = 2
+    FINISHED = 3
+    WON = 4
+    LOST = 5
+
+
+class GameSummaryForm(messages.Message):
+    """GameSummaryForm for outbound summary of a game's state"""
+    urlsafe_game_key = messages.StringField(1)
+    current_int = messages.IntegerField(2, variant=messages.Variant.INT32)
+    max_int = messages.IntegerField(3, variant=messages.Variant.INT32)
+    game_over = messages.BooleanField(4)
+    created = messages.StringField(5)
+    last_update = messages.StringField(6)
+
+
+class GameSummaryForms(messages.Message):
+    """Return a page of GameSummaryForms"""
+    games = messages.MessageField(GameSummaryForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class NewGameForm(messages.Message):
@@ -165,6 +492,8 @@ class NewGameForm(messages.Message):
     starting_int = messages.IntegerField(2, default=0)
     max_int = messages.IntegerField(3, default=31)
     max_increment = messages.IntegerField(4, default=3)
+    compact_history = messages.BooleanField(5, default=True)
+    bots = messages.IntegerField(6, default=0)
 
 
 class MakeMoveForm(messages.Message):
@@ -172,6 +501,38 @@ class MakeMoveForm(messages.Message):
     value = messages.IntegerField(1, required=True)
 
 
+class BatchMoveForm(messages.Message):
+    """A move in one of the games of a batch"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    value = messages.IntegerField(2, required=True)
+
+
+class BatchMovesForm(messages.Message):
+    """Form to submit moves in many games at once"""
+    moves = messages.MessageField(BatchMoveForm, 1, repeated=True)
+
+
+class MoveResultForm(messages.Message):
+    """Outcome of one move of a batch. game is omitted if the game could not
+       be found"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    success = messages.BooleanField(2, required=True)
+    message = messages.StringField(3)
+    game = messages.MessageField(GameForm, 4)
+
+
+class MoveResultForms(messages.Message):
+    """Outcomes of a batch of moves, in the order they were submitted"""
+    results = messages.MessageField(MoveResultForm, 1, repeated=True)
+
+
+class HintForm(messages.Message):
+    """HintForm for outbound suggested move"""
+    value = messages.IntegerField(1, required=True)
+    can_win = messages.BooleanField(2)
+    message = messages.StringField(3)
+
+
 class MoveRecord(ndb.Model):
     """Stores record of a single move in a Game. Child of Game"""
     username = ndb.StringProperty(required=True)
@@ -179,13 +540,18 @@ class MoveRecord(ndb.Model):
     datetime = ndb.DateTimeProperty(auto_now_add=True)
 
     @classmethod
-    def new_move(cls, game, move):
+    def key_for(cls, game_key, number):
+        """Returns the key of a game's nth move. Key names never collide with
+           the numeric ids allocated for moves of older games"""
+        return ndb.Key(cls, 'move-%d' % number, parent=game_key)
+
+    @classmethod
+    def new_move(cls, game, username, move):
         """Creates and returns a new move"""
-        move_id = cls.allocate_ids(size=1, parent=game.key)[0]
-        move_key = ndb.Key(cls, move_id, parent=game.key)
-        move = cls(username=game.users[0],
+        game.move_count += 1
+        move = cls(username=username,
                    move=move,
-                   key=move_key)
+                   key=cls.key_for(game.key, game.move_count))
         return move
 
     def to_form(self):
@@ -213,14 +579,51 @@ class Score(ndb.Model):
     """Score object - stores user's points for a single game"""
     points = ndb.FloatProperty(required=True)
     game_key = ndb.KeyProperty(required=True, kind="Game")
+    applied = ndb.BooleanProperty(default=False)
+    username = ndb.StringProperty(indexed=False)
+    user = ndb.KeyProperty(kind='User')
 
-    def to_form(self):
-        """Returns a ScoreForm representation of Score"""
+    @classmethod
+    def key_for(cls, game_key, user_key):
+        """Returns the key of a user's score for a game. Scores are children
+           of their game, so ending a game writes a single entity group, and
+           a user has at most one score per game, so the key is derived from
+           the user's id"""
+        return ndb.Key(cls, 'user-%s' % user_key.id(), parent=game_key)
+
+    @property
+    def user_key(self):
+        """Key of the user who scored. Scores written before they were
+           children of their game are children of their user instead"""
+        return self.user or self.key.parent()
+
+    def in_rating(self):
+        """Whether the points have been added to the user's rating. Stored
+           scores without an applied flag predate the ratings pipeline and
+           were added when they were saved"""
+        return self.applied or not Score.applied._has_value(self)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def migrate(cls, legacy_key):
+        """Moves a score from its user's entity group into its game's"""
+        legacy = legacy_key.get()
+        if not legacy:
+            return
+        score = cls(key=cls.key_for(legacy.game_key, legacy_key.parent()),
+                    points=legacy.points, game_key=legacy.game_key,
+                    applied=legacy.in_rating(), username=legacy.username,
+                    user=legacy_key.parent())
+        score.put()
+        legacy_key.delete()
+
+    def to_form(self, username=None):
+        """Returns a ScoreForm representation of Score. username is used for
+           scores recorded before the username was stored on Score"""
         form = ScoreForm()
         form.points = self.points
         form.game_key = self.game_key.urlsafe()
-        # TODO: just store username in Score model?, i.e. :
-        # form.username = self.key.parent().get().name
+        form.username = self.username or username
         return form
 
 
@@ -228,7 +631,7 @@ class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
     points = messages.FloatField(1)
     game_key = messages.StringField(2)
-    # username = messages.StringField(4)
+    username = messages.StringField(3)
 
 
 class ScoreForms(messages.Message):
@@ -236,6 +639,37 @@ class ScoreForms(messages.Message):
     scores = messages.MessageField(ScoreForm, 1, repeated=True)
 
 
+class LobbyTicket(ndb.Model):
+    """Outcome of a lobby join, written by the matcher. Keyed by the ticket
+       returned when joining"""
+    game_key = ndb.KeyProperty(kind='Game', indexed=False)
+    expired = ndb.BooleanProperty(default=False, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class LobbyForm(messages.Message):
+    """Used to join the lobby for a game with these settings"""
+    max_int = messages.IntegerField(1, default=31)
+    max_increment = messages.IntegerField(2, default=3)
+    players = messages.IntegerField(3, default=2)
+
+
+class LobbyTicketForm(messages.Message):
+    """A lobby ticket and, once matched, the game it was matched into"""
+    ticket = messages.StringField(1, required=True)
+    matched = messages.BooleanField(2, required=True)
+    urlsafe_game_key = messages.StringField(3)
+    message = messages.StringField(4)
+
+
+class ReminderRun(ndb.Model):
+    """Checkpoint for one reminder window's scan over idle games. Keyed by
+       the window number"""
+    cutoff = ndb.DateTimeProperty(required=True, indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+
+
 class StringMessage(messages.Message):
     """StringMessage -- outbound (single) string message"""
     message = messages.StringField(1, required=True)
@@ -0,0 +1,115 @@
+# ratelimit.py - token bucket rate limiting for Baskin Robbins 31 Game API
+
+import functools
+import httplib
+import math
+import os
+import threading
+import time
+
+import endpoints
+from google.appengine.api import memcache
+
+BUCKET_KEY = 'ratelimit:%s:%s'
+# Concurrent requests from one user retry a lost cas this many times before
+# falling back to this instance's own buckets
+CAS_RETRIES = 3
+MAX_LOCAL_BUCKETS = 10000
+
+
+def _parse_limits(value):
+    """Parses 'endpoint=rate/burst,...' into {endpoint: (rate, burst)}"""
+    limits = {}
+    for entry in value.split(','):
+        if entry.strip():
+            name, limit = entry.split('=')
+            rate, burst = limit.split('/')
+            limits[name.strip()] = (float(rate), int(burst))
+    return limits
+
+
+# Limits given to rate_limited, by endpoint method name
+DEFAULT_LIMITS = {}
+# Overrides for DEFAULT_LIMITS, e.g. 'get_game=20/40'
+LIMITS = _parse_limits(os.environ.get('RATE_LIMITS', ''))
+
+_local_buckets = {}
+_local_lock = threading.Lock()
+
+
+class RateLimitedException(endpoints.ServiceException):
+    """Too many requests, the message says when to retry. Endpoints only
+       passes 400, 401, 403, 404, 409, 410, 412 and 413 through to clients,
+       so this is a 403 like Google APIs' rateLimitExceeded rather than 429"""
+    http_status = httplib.FORBIDDEN
+
+
+def _refill(bucket, rate, burst, now):
+    if bucket is None:
+        return float(burst)
+    tokens, updated = bucket
+    return min(float(burst), tokens + max(0.0, now - updated) * rate)
+
+
+def _take_local(key, rate, burst, now):
+    """Takes a token from this instance's bucket. Used when memcache is
+       unavailable or too contended"""
+    with _local_lock:
+        tokens = _refill(_local_buckets.get(key), rate, burst, now)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        if len(_local_buckets) >= MAX_LOCAL_BUCKETS:
+            _local_buckets.clear()
+        _local_buckets[key] = (tokens - 1, now)
+        return 0
+
+
+def take(name, identity, rate, burst):
+    """Takes a token from identity's bucket for endpoint name, which holds up
+       to burst tokens and refills at rate per second. Returns 0 if the call
+       is allowed, otherwise the seconds until a token is available"""
+    key = BUCKET_KEY % (name, identity)
+    now = time.time()
+    expires = int(math.ceil(burst / rate)) + 1
+    client = memcache.Client()
+    for attempt in range(CAS_RETRIES):
+        bucket = client.gets(key)
+        tokens = _refill(bucket, rate, burst, now)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        if bucket is None:
+            if client.add(key, (tokens - 1, now), time=expires):
+                return 0
+        elif client.cas(key, (tokens - 1, now), time=expires):
+            return 0
+    return _take_local(key, rate, burst, now)
+
+
+def _identity(service):
+    """The authenticated user's email, or the client's address"""
+    user = endpoints.get_current_user()
+    if user:
+        return user.email()
+    request_state = getattr(service, 'request_state', None)
+    return 'ip:%s' % getattr(request_state, 'remote_address', None)
+
+
+def rate_limited(rate, burst):
+    """Limits an endpoint method to rate calls per second per user, allowing
+       bursts of up to burst calls. Calls over the limit raise
+       RateLimitedException with a retry-after hint"""
+    def decorator(func):
+        DEFAULT_LIMITS[func.__name__] = (rate, burst)
+
+        @functools.wraps(func)
+        def wrapper(self, request):
+            limit_rate, limit_burst = LIMITS.get(func.__name__, (rate, burst))
+            retry_after = take(func.__name__, _identity(self), limit_rate,
+                               limit_burst)
+            if retry_after:
+                raise RateLimitedException(
+                    "Rate limit exceeded, retry after %.1f seconds" %
+                    (math.ceil(retry_after * 10) / 10))
+            return func(self, request)
+        return wrapper
+    return decorator
@@ -0,0 +1,156 @@
+# ratings.py - deferred rating aggregation for Baskin Robbins 31 Game API
+
+import logging
+import time
+from collections import OrderedDict, defaultdict
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import leaderboard
+from models import User, Score
+
+APPLY_URL = '/tasks/apply_ratings'
+RECONCILE_URL = '/tasks/reconcile_ratings'
+RATINGS_QUEUE = 'ratings'
+# Games finishing within the same window share a single aggregation task
+BATCH_WINDOW = 10
+BATCH_SIZE = 500
+
+
+def schedule_apply():
+    """Enqueues a rating aggregation task for the current batch window"""
+    window = int(time.time()) // BATCH_WINDOW
+    try:
+        taskqueue.add(url=APPLY_URL,
+                      queue_name=RATINGS_QUEUE,
+                      name='apply-ratings-%d' % window,
+                      countdown=BATCH_WINDOW)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+
+# A transaction spans the user's entity group and one group per score's game
+MAX_SCORE_GROUPS = 24
+
+
+@ndb.transactional_tasklet(xg=True)
+def _apply_user_scores(user_key, score_keys):
+    """Adds any unapplied scores to a user's rating and marks them applied.
+       Scores are children of their games, so this is a cross-group
+       transaction over at most MAX_SCORE_GROUPS scores, and is safe to
+       retry"""
+    entities = yield ndb.get_multi_async([user_key] + score_keys)
+    user = entities[0]
+    scores = [score for score in entities[1:]
+              if score and not score.applied]
+    if not user or not scores:
+        raise ndb.Return(None)
+    old_rating = user.rating
+    for score in scores:
+        user.rating += score.points
+        score.applied = True
+    yield ndb.put_multi_async([user] + scores)
+    raise ndb.Return((user.name, old_rating, user.rating))
+
+
+def _rounds(units):
+    """Splits (user_key, score_keys) units into rounds in which no two units
+       share a user or a game, so the transactions run together in a round
+       never contend. Every player of a game is applied in its own round"""
+    rounds = []
+    for user_key, score_keys in units:
+        groups = set([user_key] + [key.parent() for key in score_keys])
+        for busy, round_units in rounds:
+            if not busy & groups:
+                busy.update(groups)
+                round_units.append((user_key, score_keys))
+                break
+        else:
+            rounds.append((groups, [(user_key, score_keys)]))
+    return [round_units for busy, round_units in rounds]
+
+
+def apply_pending(batch_size=BATCH_SIZE):
+    """Applies a batch of pending scores, in transactions of one user and at
+       most MAX_SCORE_GROUPS of their scores. Transactions that share a game
+       run one after another, the rest concurrently. Returns True if there
+       may be more pending scores"""
+    scores = Score.query(Score.applied == False).fetch(batch_size)
+    by_user = defaultdict(list)
+    for score in scores:
+        by_user[score.user_key].append(score.key)
+    units = [(user_key, keys[start:start + MAX_SCORE_GROUPS])
+             for user_key, keys in by_user.items()
+             for start in range(0, len(keys), MAX_SCORE_GROUPS)]
+
+    changes = OrderedDict()
+    for round_units in _rounds(units):
+        futures = [(user_key, _apply_user_scores(user_key, keys))
+                   for user_key, keys in round_units]
+        for user_key, future in futures:
+            try:
+                change = future.get_result()
+            except Exception:
+                # Left pending, the next run picks these scores up again
+                logging.exception('Failed to apply scores')
+                continue
+            if change:
+                name, old_rating, rating = change
+                if user_key in changes:
+                    old_rating = changes[user_key][1]
+                changes[user_key] = (name, old_rating, rating)
+
+    leaderboard.update_ratings(changes.values())
+    return len(scores) == batch_size
+
+
+@ndb.transactional
+def _save_reconciled(user_key, expected_rating, rating):
+    """Stores a rebuilt rating unless the user's rating changed since the
+       scores were read"""
+    user = user_key.get()
+    if not user or user.rating != expected_rating:
+        return None
+    user.rating = rating
+    user.put()
+    return user
+
+
+def _reconcile_user(user_key):
+    """Rebuilds a user's rating from their applied scores. Pending scores
+       are left to apply_pending, and the rebuild is skipped if any are
+       applied meanwhile"""
+    user = user_key.get()
+    if not user:
+        return None
+    score_keys = Score.query(Score.user == user_key).fetch(keys_only=True)
+    # Scores not yet moved into their game's entity group by MigrateScores
+    score_keys += Score.query(ancestor=user_key).fetch(keys_only=True)
+    scores = ndb.get_multi(score_keys)
+    rating = float(sum(score.points for score in scores
+                       if score and score.in_rating()))
+    if rating == user.rating:
+        return None
+    old_rating = user.rating
+    if not _save_reconciled(user_key, old_rating, rating):
+        logging.info('Rating for %s changed while reconciling', user.name)
+        return None
+    logging.warning('Rating for %s drifted from %s to %s',
+                    user.name, old_rating, rating)
+    return (user.name, old_rating, rating)
+
+
+def reconcile(cursor=None, batch_size=BATCH_SIZE):
+    """Rebuilds ratings from Score for one page of users. Returns the cursor
+       for the next page, or None when all users are done"""
+    user_keys, next_cursor, more = User.query().fetch_page(
+        batch_size, start_cursor=cursor, keys_only=True)
+    for user_key in user_keys:
+        _reconcile_user(user_key)
+    if not more:
+        # Many users may have moved, so rebuild the rankings snapshot once
+        # the whole run is done
+        leaderboard.invalidate()
+    return next_cursor if more else None
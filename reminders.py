@@ -0,0 +1,124 @@
+# reminders.py - batched reminder emails for Baskin Robbins 31 Game API
+
+import logging
+import time
+from datetime import datetime, timedelta
+
+from google.appengine.api import mail, memcache, app_identity, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import User, Game, ReminderRun
+
+SCAN_URL = '/tasks/reminders/scan'
+SEND_URL = '/tasks/reminders/send'
+REMINDER_QUEUE = 'reminders'
+# Each user receives at most one reminder per window
+WINDOW = 60 * 60
+IDLE_TIME = timedelta(hours=1)
+SCAN_BATCH_SIZE = 500
+SENT_KEY = 'reminder:%d:%s'
+# Unfinished scans are resumed, and finished ones kept, for this many windows
+RUN_WINDOWS = 24
+
+
+def current_window():
+    return int(time.time()) // WINDOW
+
+
+def start(window):
+    """Starts the scan for a window, resumes the interrupted scans of recent
+       windows from their checkpoints and deletes the runs of older ones"""
+    run = ReminderRun.get_or_insert(str(window),
+                                    cutoff=datetime.now() - IDLE_TIME)
+    # Window ids have the same number of digits, so key order is numeric
+    oldest = ndb.Key(ReminderRun, str(window - RUN_WINDOWS))
+    ndb.delete_multi(ReminderRun.query(ReminderRun.key < oldest)
+                     .fetch(keys_only=True))
+    runs = ReminderRun.query(ReminderRun.key >= oldest,
+                             ReminderRun.key < run.key).fetch()
+    for run in runs + [run]:
+        if not run.done:
+            taskqueue.add(url=SCAN_URL,
+                          queue_name=REMINDER_QUEUE,
+                          params={'window': run.key.id(),
+                                  'cursor': run.cursor or ''})
+
+
+def scan(window, cursor):
+    """Scans one page of idle active games and fans it out to a send task.
+       The checkpoint and the follow-up tasks are committed together, so a
+       stale or duplicate scan task for the same page is a no-op"""
+    run = ReminderRun.get_by_id(str(window))
+    if not run or run.done or (run.cursor or '') != cursor:
+        return
+    query = Game.query(Game.game_over == False,
+                       Game.last_update < run.cutoff)
+    game_keys, next_cursor, more = query.fetch_page(
+        SCAN_BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor) if cursor
+        else None, keys_only=True)
+    next_cursor = next_cursor.urlsafe() if more and next_cursor else None
+    _checkpoint(window, cursor, next_cursor, game_keys)
+
+
+@ndb.transactional
+def _checkpoint(window, cursor, next_cursor, game_keys):
+    run = ReminderRun.get_by_id(str(window))
+    if run.done or (run.cursor or '') != cursor:
+        return
+    if game_keys:
+        taskqueue.add(url=SEND_URL,
+                      queue_name=REMINDER_QUEUE,
+                      params={'window': window,
+                              'game_key': [key.urlsafe()
+                                           for key in game_keys]},
+                      transactional=True)
+    if next_cursor:
+        taskqueue.add(url=SCAN_URL,
+                      queue_name=REMINDER_QUEUE,
+                      params={'window': window, 'cursor': next_cursor},
+                      transactional=True)
+    run.cursor = next_cursor
+    run.done = next_cursor is None
+    run.put()
+
+
+def send(window, urlsafe_game_keys):
+    """Emails the current player of each still active game, skipping users
+       that were already reminded during this window"""
+    games = ndb.get_multi([ndb.Key(urlsafe=key) for key in urlsafe_game_keys])
+    names = set(game.users[0] for game in games
+                if game and not game.game_over)
+    if not names:
+        return
+
+    sent_keys = dict((SENT_KEY % (window, name), name) for name in names)
+    already_sent = memcache.add_multi(
+        dict((key, 1) for key in sent_keys), time=WINDOW)
+    names = [name for key, name in sent_keys.items()
+             if key not in already_sent]
+    users = User.get_by_names_async(names).get_result()
+
+    app_id = app_identity.get_application_id()
+    subject = 'This is a reminder!'
+    body = """\
+        Hello, you have one or more pending Baskin Robbins 31 games!\
+    """
+    failed = []
+    for user in users:
+        if not user or not user.email:
+            continue
+        try:
+            # This will send test emails, the arguments to send_mail are:
+            # from, to, subject, body
+            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                           user.email,
+                           subject,
+                           body)
+        except Exception:
+            logging.exception('Failed to send reminder to %s', user.name)
+            failed.append(SENT_KEY % (window, user.name))
+    if failed:
+        # Let the task retry the users that were not reminded
+        memcache.delete_multi(failed)
+        raise Exception('%d reminders failed to send' % len(failed))
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# rerate.py - offline rating recomputation for Baskin Robbins 31 Game API
+"""Recomputes user ratings from a local Datastore Admin backup of the User,
+Score and Game kinds, reports drift from the stored ratings and can write
+corrections back through remote_api.
+
+Backup output files are read in parallel by a process pool. Each worker
+streams its files and only keeps per-user totals, and finished games for the
+elo formula are spilled to sorted temporary runs, so memory is bounded by the
+number of users rather than scores or games.
+
+Usage:
+    python rerate.py --sdk /path/to/google_appengine [--formula sum|elo]
+        [--processes 4] [--output ratings.csv] [--write app-id] backup_dir
+"""
+
+import argparse
+import csv
+import heapq
+import json
+import marshal
+import multiprocessing
+import os
+import shutil
+import tempfile
+from collections import OrderedDict, defaultdict
+
+from benchmark import _setup_sdk
+
+# Ratings differing by less than this are float summation noise
+DRIFT_TOLERANCE = 1e-6
+# Finished games each worker sorts in memory before spilling a run
+SPILL_SIZE = 200000
+REPORT_SIZE = 25
+
+ELO_START = 1500.0
+ELO_K = 32.0
+
+
+def _backup_files(backup_dir):
+    """Datastore Admin backup output files under backup_dir"""
+    for path, dirs, files in os.walk(backup_dir):
+        for name in sorted(files):
+            if name.startswith('output-'):
+                yield os.path.join(path, name)
+
+
+def _entities(path):
+    """Streams the entities in one backup output file"""
+    from google.appengine.api import datastore
+    from google.appengine.api.files import records
+    from google.appengine.datastore import entity_pb
+
+    with open(path, 'rb') as f:
+        for record in records.RecordsReader(f):
+            yield datastore.Entity.FromPb(entity_pb.EntityProto(
+                contents=record))
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _spill(rows, spill_dir):
+    """Writes sorted finished games to a run file and returns its path"""
+    rows.sort()
+    fd, path = tempfile.mkstemp(dir=spill_dir, suffix='.run')
+    with os.fdopen(fd, 'wb') as f:
+        for row in rows:
+            marshal.dump(row, f)
+    del rows[:]
+    return path
+
+
+def _read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                return
+
+
+def read_shard(job):
+    """Worker: aggregates one backup file. Returns per-user applied and
+       pending score totals keyed by user id, stored users and, for the elo
+       formula, paths of sorted runs of (finished time, winners, loser)"""
+    path, formula, spill_dir = job
+    result = {
+        'applied': defaultdict(float),
+        'pending': defaultdict(float),
+        'scores': 0,
+        'users': {},
+        'runs': [],
+    }
+    games = []
+    for entity in _entities(path):
+        kind = entity.key().kind()
+        if kind == 'Score':
+            # Scores written before Score.user are children of their user
+            user = entity.get('user') or entity.key().parent()
+            user_id = user.id_or_name()
+            # Scores from before the ratings pipeline were added to the
+            # rating when they were written, and have no applied property
+            totals = result['applied' if entity.get('applied', True)
+                            else 'pending']
+            totals[user_id] += entity['points']
+            result['scores'] += 1
+        elif kind == 'User':
+            result['users'][entity.key().id_or_name()] = (
+                entity['name'], entity.get('rating') or 0.0)
+        elif kind == 'Game' and formula == 'elo':
+            if not entity.get('game_over') or not entity.get('loser'):
+                continue
+            finished = entity['last_update'].strftime('%Y%m%d%H%M%S%f')
+            games.append((finished, _as_list(entity.get('winners')),
+                          entity['loser']))
+            if len(games) >= SPILL_SIZE:
+                result['runs'].append(_spill(games, spill_dir))
+    if games:
+        result['runs'].append(_spill(games, spill_dir))
+    result['applied'] = dict(result['applied'])
+    result['pending'] = dict(result['pending'])
+    return result
+
+
+def aggregate(backup_dir, formula, processes, spill_dir):
+    """Reads every backup file on a process pool and merges the results"""
+    jobs = [(path, formula, spill_dir)
+            for path in _backup_files(backup_dir)]
+    totals = {
+        'applied': defaultdict(float),
+        'pending': defaultdict(float),
+        'scores': 0,
+        'users': {},
+        'runs': [],
+    }
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(read_shard, jobs):
+            for user_id, points in result['applied'].items():
+                totals['applied'][user_id] += points
+            for user_id, points in result['pending'].items():
+                totals['pending'][user_id] += points
+            totals['scores'] += result['scores']
+            totals['users'].update(result['users'])
+            totals['runs'].extend(result['runs'])
+    finally:
+        pool.close()
+        pool.join()
+    return totals
+
+
+def elo_ratings(runs):
+    """Replays finished games in order. A loser is treated as losing to each
+       winner, with K split between the pairings"""
+    ratings = defaultdict(lambda: ELO_START)
+    for finished, winners, loser in heapq.merge(
+            *[_read_run(path) for path in runs]):
+        if not winners:
+            continue
+        k = ELO_K / len(winners)
+        loser_rating = ratings[loser]
+        change = 0.0
+        for winner in winners:
+            expected = 1.0 / (
+                1 + 10 ** ((loser_rating - ratings[winner]) / 400.0))
+            ratings[winner] += k * (1 - expected)
+            change += k * (1 - expected)
+        ratings[loser] = loser_rating - change
+    return ratings
+
+
+def recompute(totals, formula):
+    """Returns rows of (user id, name, stored rating, recomputed rating).
+       The sum formula only counts applied scores, matching what the
+       stored rating should hold until the ratings pipeline runs"""
+    if formula == 'elo':
+        ratings = elo_ratings(totals['runs'])
+    for user_id, (name, stored) in sorted(totals['users'].items()):
+        if formula == 'elo':
+            rating = ratings.get(name, ELO_START)
+        else:
+            rating = totals['applied'].get(user_id, 0.0)
+        yield user_id, name, stored, rating
+
+
+def write_back(app_id, corrections):
+    """Stores each (user id, backup rating, recomputed rating) in the live
+       app through remote_api. Each user is written in its own transaction,
+       and only if their rating is still the one in the backup, so ratings
+       changed since the backup are left for the next run"""
+    from google.appengine.ext import ndb
+    from google.appengine.ext.remote_api import remote_api_stub
+    remote_api_stub.ConfigureRemoteApiForOAuth(
+        '%s.appspot.com' % app_id, '/_ah/remote_api')
+    import leaderboard
+    import ratings
+    from models import User
+
+    skipped = 0
+    for user_id, stored, rating in corrections:
+        if not ratings._save_reconciled(ndb.Key(User, user_id), stored,
+                                        rating):
+            skipped += 1
+    if skipped:
+        print('Skipped %d users whose rating changed since the backup' %
+              skipped)
+    leaderboard.invalidate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('backup_dir',
+                        help='local copy of a User, Score and Game backup')
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--formula', choices=('sum', 'elo'), default='sum')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--output',
+                        help='write every user\'s ratings to this CSV file')
+    parser.add_argument('--write', metavar='APP_ID',
+                        help='correct drifted ratings in this app')
+    args = parser.parse_args()
+    if args.write and args.formula != 'sum':
+        parser.error('only the sum formula can be written back')
+
+    _setup_sdk(args.sdk)
+    spill_dir = tempfile.mkdtemp(prefix='rerate-')
+    try:
+        totals = aggregate(args.backup_dir, args.formula, args.processes,
+                           spill_dir)
+        writer = None
+        if args.output:
+            output = open(args.output, 'wb')
+            writer = csv.writer(output)
+            writer.writerow(['user_id', 'name', 'stored', args.formula])
+        corrections = []
+        drifted = []
+        for user_id, name, stored, rating in recompute(totals, args.formula):
+            if writer:
+                writer.writerow([user_id, name.encode('utf-8'), stored,
+                                 rating])
+            drift = rating - stored
+            if args.formula == 'sum' and abs(drift) > DRIFT_TOLERANCE:
+                drifted.append((abs(drift), name, stored, rating))
+                # A backup isn't a snapshot across kinds, so a score applied
+                # while User and Score were exported shows up as drift. Users
+                # with pending scores are left to the ratings pipeline
+                if user_id not in totals['pending']:
+                    corrections.append((user_id, stored, rating))
+        if writer:
+            output.close()
+    finally:
+        shutil.rmtree(spill_dir)
+
+    pending = sum(1 for points in totals['pending'].values() if points)
+    report = OrderedDict([
+        ('formula', args.formula),
+        ('users', len(totals['users'])),
+        ('scores', totals['scores']),
+        ('users_with_pending_scores', pending),
+    ])
+    if args.formula == 'sum':
+        report['drifted_users'] = len(drifted)
+        report['total_drift'] = round(
+            sum(drift for drift, name, stored, rating in drifted), 6)
+        report['largest_drift'] = [
+            OrderedDict([('name', name), ('stored', stored),
+                         ('recomputed', rating)])
+            for drift, name, stored, rating in heapq.nlargest(
+                REPORT_SIZE, drifted)]
+    print(json.dumps(report, indent=2))
+
+    if args.write and corrections:
+        write_back(args.write, corrections)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# solver.py - memoized move solver for Baskin Robbins 31 games
+
+import threading
+from array import array
+from collections import OrderedDict, namedtuple
+
+# Tables are shared by all requests on an instance and evicted least
+# recently used first once they hold more than this many positions
+MAX_CACHED_POSITIONS = 2000000
+
+Hint = namedtuple('Hint', ['value', 'loser_offset'])
+
+_tables = OrderedDict()
+_cached_positions = [0]
+_lock = threading.Lock()
+
+
+class _Table(object):
+    """Solved positions for one (players, max_increment) pair.
+
+    A position is the count remaining before max_int is reached, seen by the
+    player to move. loser[r] is the turn offset, relative to that player, of
+    the player who ends up losing when everyone minimizes their own chance
+    of losing, and best[r] is the move that achieves it.
+
+    The smallest safe move from r is to the nearest position j < r whose
+    loser is not the player just before the mover, so each position is
+    solved in O(1) from (r - j, loser[j], loser[r - 1]). That state is
+    bounded, so the table becomes periodic and is only built until the
+    period is found."""
+    __slots__ = ('players', 'max_increment', 'loser', 'best', 'last_safe',
+                 'states', 'period_start', 'period')
+
+    def __init__(self, players, max_increment):
+        self.players = players
+        self.max_increment = max_increment
+        # Position 0 is unused, at position 1 every move loses
+        self.loser = array('l', [0, 0])
+        self.best = array('l', [0, 1])
+        self.last_safe = 1
+        self.states = {}
+        self.period_start = None
+        self.period = None
+
+    def __len__(self):
+        return len(self.loser)
+
+    def _extend(self, remaining):
+        """Solves positions up to remaining, or until the period is found"""
+        players, loser, best = self.players, self.loser, self.best
+        r = len(loser)
+        while r <= remaining and self.period is None:
+            j = self.last_safe
+            state = (r - j, loser[j], loser[r - 1])
+            if state in self.states:
+                self.period_start = self.states[state]
+                self.period = r - self.period_start
+                self.states = None
+                break
+            self.states[state] = r
+
+            if r - j <= self.max_increment:
+                best.append(r - j)
+                loser.append((1 + loser[j]) % players)
+            else:
+                # Every move loses, so prolong the game
+                best.append(1)
+                loser.append((1 + loser[r - 1]) % players)
+            if loser[r] != players - 1:
+                self.last_safe = r
+            r += 1
+
+    def lookup(self, remaining):
+        """Returns (best move, loser offset) for a position"""
+        self._extend(remaining)
+        if remaining >= len(self.loser):
+            remaining = (self.period_start +
+                         (remaining - self.period_start) % self.period)
+        return self.best[remaining], self.loser[remaining]
+
+
+def best_move(current_int, max_int, max_increment, players):
+    """Returns a Hint with the loss-minimizing move for the player to move
+       and the turn offset of the player expected to lose (0 means the
+       player to move cannot avoid losing against best play)"""
+    remaining = max_int - current_int
+    if remaining < 1 or max_increment < 1 or players < 2:
+        raise ValueError("No moves left in this game")
+    if remaining == 1:
+        return Hint(1, 0)
+
+    key = (players, max_increment)
+    with _lock:
+        table = _tables.pop(key, None)
+        if table is None:
+            table = _Table(players, max_increment)
+        else:
+            _cached_positions[0] -= len(table)
+        value, loser_offset = table.lookup(remaining)
+        _tables[key] = table
+        _cached_positions[0] += len(table)
+        while (_cached_positions[0] > MAX_CACHED_POSITIONS and
+               len(_tables) > 1):
+            _, evicted = _tables.popitem(last=False)
+            _cached_positions[0] -= len(evicted)
+    return Hint(value, loser_offset)
+
+
+def clear_cache():
+    """Drops all cached tables"""
+    with _lock:
+        _tables.clear()
+        _cached_positions[0] = 0
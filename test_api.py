@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# test_api.py - testbed tests for Baskin Robbins 31 Game API
+"""Calls the BaskinRobbins31Game endpoints against the App Engine testbed
+stubs through the benchmark harness, which records the RPCs made by every
+call. Needs the App Engine Python SDK:
+
+    APPENGINE_SDK=/path/to/google_appengine python -m unittest test_api
+"""
+
+import os
+import unittest
+
+import benchmark
+
+try:
+    benchmark._setup_sdk(os.environ.get('APPENGINE_SDK'))
+    HAVE_SDK = True
+except ImportError:
+    HAVE_SDK = False
+
+
+@unittest.skipUnless(HAVE_SDK, 'App Engine SDK not found, set APPENGINE_SDK')
+class ApiTestCase(unittest.TestCase):
+    """Testbed with two users, alice and bob"""
+
+    def setUp(self):
+        self.bench = benchmark.Benchmark(seed=31)
+        for name in ('alice', 'bob'):
+            self.bench.call('create_user', as_user=name, username=name)
+
+    def tearDown(self):
+        self.bench.close()
+
+    def new_game(self, players=('alice', 'bob'), **fields):
+        """Creates a game and returns its GameForm"""
+        return self.bench.call('new_game', as_user=players[0],
+                               other_players=list(players[1:]), **fields)
+
+    def rpcs(self, name):
+        """RPC counts of the last call recorded under name"""
+        return self.bench.recorder.samples[name][-1][1]
+
+    def datastore_rpcs(self, name):
+        """Datastore RPC counts of the last call recorded under name"""
+        return dict((call.split('.', 1)[1], count)
+                    for call, count in self.rpcs(name).items()
+                    if call.startswith('datastore_v3.'))
+
+    def warm_users(self):
+        """Reads every user through both index kinds, so later lookups are
+           served from memcache"""
+        from models import User
+        for name in ('alice', 'bob'):
+            User.get_by_name(name)
+            User.get_by_email('%s@example.com' % name)
+
+
+class AllocateIdsTest(ApiTestCase):
+    """MoveRecord and Score keys are derived, so moves allocate no ids"""
+
+    def test_make_move(self):
+        for compact_history in (True, False):
+            game = self.new_game(max_int=10, compact_history=compact_history)
+            while not game.game_over:
+                game = self.bench.call(
+                    'make_move', as_user=game.users[0],
+                    urlsafe_game_key=game.urlsafe_game_key, value=3)
+                # The Counter reads 0 for RPCs never made, so the recorded
+                # commit shows the call's RPCs were actually counted
+                rpcs = self.rpcs('make_move')
+                self.assertEqual(rpcs['datastore_v3.Commit'], 1)
+                self.assertEqual(rpcs['datastore_v3.AllocateIds'], 0)
+
+    def test_quit_game(self):
+        for compact_history in (True, False):
+            game = self.new_game(compact_history=compact_history)
+            self.bench.call('quit_game', as_user='bob',
+                            urlsafe_game_key=game.urlsafe_game_key)
+            rpcs = self.rpcs('quit_game')
+            self.assertEqual(rpcs['datastore_v3.Commit'], 1)
+            self.assertEqual(rpcs['datastore_v3.AllocateIds'], 0)
+            self.assertEqual(self.bench.recorder.errors['quit_game'], 0)
+
+
+class ConcurrentMoveTest(ApiTestCase):
+    """Game.version rejects the second of two moves read from the same
+       version of a game"""
+
+    def test_interleaved_saves(self):
+        import endpoints
+        from google.appengine.ext import ndb
+        from utils import get_game
+        form = self.new_game()
+        games = []
+        for value in (1, 2):
+            ndb.get_context().clear_cache()
+            game = get_game(form.urlsafe_game_key)
+            games.append(game.make_move(value)[0])
+
+        # Both transactions are started before either is waited on
+        futures = [self.bench.service._save_move_results_async(**results)
+                   for results in games]
+        outcomes = []
+        for future in futures:
+            try:
+                future.get_result()
+                outcomes.append('saved')
+            except endpoints.ConflictException:
+                outcomes.append('conflict')
+        self.assertEqual(sorted(outcomes), ['conflict', 'saved'])
+
+        ndb.get_context().clear_cache()
+        stored = ndb.Key(urlsafe=form.urlsafe_game_key).get(
+            use_cache=False, use_memcache=False)
+        self.assertEqual(stored.version, form.version + 1)
+        self.assertEqual(len(stored.history()), 1)
+        saved = games[outcomes.index('saved')]['game']
+        self.assertEqual(stored.current_int, saved.current_int)
+
+
+class ScoreRpcTest(ApiTestCase):
+    """quit_game and score reads use the denormalized results on Game and
+       Score, with user lookups served from memcache"""
+
+    def setUp(self):
+        super(ScoreRpcTest, self).setUp()
+        self.game = self.new_game()
+        self.warm_users()
+        self.bench.call('quit_game', as_user='bob',
+                        urlsafe_game_key=self.game.urlsafe_game_key)
+
+    def test_quit_game(self):
+        # One transaction reading the game and writing it with both scores
+        self.assertEqual(self.datastore_rpcs('quit_game'),
+                         {'BeginTransaction': 1, 'Get': 1, 'Put': 1,
+                          'Commit': 1})
+
+    def test_get_game_scores(self):
+        # Served from the game cache written through by quit_game
+        forms = self.bench.call('get_game_scores',
+                                urlsafe_game_key=self.game.urlsafe_game_key)
+        self.assertEqual(len(forms.scores), 2)
+        self.assertEqual(self.datastore_rpcs('get_game_scores'), {})
+
+    def test_get_user_scores(self):
+        for attempt in range(2):
+            forms = self.bench.call('get_user_scores', username='bob')
+        self.assertEqual([score.points for score in forms.scores], [-1.0])
+        # The Score.user query and the ancestor query for scores not yet
+        # migrated, the user itself comes from memcache
+        self.assertEqual(self.datastore_rpcs('get_user_scores'),
+                         {'RunQuery': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,26 @@
 # utils.py - General use functions
 
 import endpoints
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
-from models import Game, User
+import instrumentation
+from instrumentation import instrumented
+from models import ArchivedGame, Game, GameStatus, User
 
+# Properties returned for game summaries. Each status filter has a matching
+# composite index in index.yaml
+GAME_SUMMARY_PROJECTION = [Game.created, Game.current_int, Game.max_int,
+                           Game.last_update]
+# Marks cursors of get_user_games pages that have moved on to archived games
+ARCHIVE_CURSOR_PREFIX = 'archive:'
 
-def get_by_urlsafe(urlsafe_key, model):
-    """Returns a datastore entity by urlsafe key"""
+
+def _key_from_urlsafe(urlsafe_key):
+    """Returns an ndb.Key, raising BadRequestException for invalid keys"""
     try:
-        key = ndb.Key(urlsafe=urlsafe_key)
+        return ndb.Key(urlsafe=urlsafe_key)
     except TypeError:
         raise endpoints.BadRequestException('Invalid Key')
     except Exception, e:
@@ -18,28 +29,192 @@ def get_by_urlsafe(urlsafe_key, model):
         else:
             raise
 
-    entity = key.get()
-    if not entity:
-        raise endpoints.NotFoundException("Entity not found")
-    if not isinstance(entity, model):
-        raise ValueError('Incorrect Kind')
-    return entity
 
+GAME_CACHE_PREFIX = 'game:'
 
-def get_games_by_username(username):
-    """Get games by unique username"""
-    games = Game.query(Game.users.IN((username,))).fetch()
-    if not games and not User.query(User.name == username).get():
-        raise endpoints.NotFoundException('User does not exist')
+
+def _game_cache_key(urlsafe_key):
+    return GAME_CACHE_PREFIX + urlsafe_key
+
+
+@instrumented
+def get_game(urlsafe_key):
+    """Returns a Game by urlsafe key, from the game cache if possible"""
+    game = memcache.get(_game_cache_key(urlsafe_key))
+    if game is None:
+        key = _key_from_urlsafe(urlsafe_key)
+        game = key.get()
+        if game is None and key.kind() == Game._get_kind():
+            archived = ArchivedGame.key_for(key).get()
+            game = archived.to_game() if archived else None
+        if not game:
+            raise endpoints.NotFoundException("Entity not found")
+        if not isinstance(game, Game):
+            raise ValueError('Incorrect Kind')
+        cache_game(game)
+    return game
+
+
+@instrumented
+def get_games(urlsafe_keys):
+    """Returns a dict of Games by urlsafe key, from the game cache if possible
+       and otherwise with a single get_multi. Invalid keys and keys of
+       missing games are left out"""
+    games = memcache.get_multi(urlsafe_keys, key_prefix=GAME_CACHE_PREFIX)
+    keys = {}
+    for urlsafe_key in set(urlsafe_keys) - set(games):
+        try:
+            key = _key_from_urlsafe(urlsafe_key)
+        except endpoints.BadRequestException:
+            continue
+        if key.kind() == Game._get_kind():
+            keys[key] = urlsafe_key
+    missing = []
+    for key, game in zip(keys, ndb.get_multi(list(keys))):
+        if game:
+            games[keys[key]] = game
+        else:
+            missing.append(key)
+    if missing:
+        for archived in ndb.get_multi(
+                [ArchivedGame.key_for(key) for key in missing]):
+            if archived:
+                game = archived.to_game()
+                games[keys[game.key]] = game
     return games
 
 
+def cache_game(game):
+    """Writes a game to the game cache unless a newer version is cached"""
+    cache_key = _game_cache_key(game.key.urlsafe())
+    client = memcache.Client()
+    cached = client.gets(cache_key)
+    if cached is None:
+        if client.add(cache_key, game):
+            return
+    elif cached.version >= game.version:
+        return
+    elif client.cas(cache_key, game):
+        return
+    # Lost a race with another writer, let the next read repopulate
+    client.delete(cache_key)
+
+
+def uncache_game(game_key):
+    """Removes a game from the game cache"""
+    memcache.delete(_game_cache_key(game_key.urlsafe()))
+
+
+@ndb.transactional_tasklet
+def _commit_game_async(game, moves, expected_version, scores):
+    """Transaction saving a game with the moves and scores made by a move.
+       Moves and scores are children of the game, so this only writes the
+       game's entity group. Rejects the move if the game changed since it
+       was read"""
+    # Called again by ndb for every retry of the transaction
+    instrumentation.count('transaction_attempts')
+    stored = yield game.key.get_async(use_cache=False)
+    if stored.version != expected_version:
+        raise endpoints.ConflictException(
+            "Game was updated by another move, reload it and try again")
+    game.version = expected_version + 1
+    # Moves of compact_history games are packed into the game itself
+    yield (game.put_async(),
+           ndb.put_multi_async([move for move in moves if move]),
+           ndb.put_multi_async(scores or []))
+
+
+@ndb.tasklet
+def save_game_async(game, moves, scores=None):
+    """Saves a game after a move, quit or forfeit and writes it through to
+       the game cache. Raises ConflictException if the game was changed
+       since it was read"""
+    try:
+        yield _commit_game_async(game, moves, game.version, scores)
+    except Exception:
+        # The cached game may be stale or ahead of the datastore now
+        uncache_game(game.key)
+        raise
+    cache_game(game)
+
+
+@instrumented
+def get_game_summaries_by_username(username, status=GameStatus.ALL,
+                                   limit=20, cursor=None):
+    """Get a page of a user's games, newest first, as projections with only
+       the GAME_SUMMARY_PROJECTION properties (plus game_over for
+       GameStatus.ALL). Games in the Game kind are listed first, followed by
+       archived games for every status but ACTIVE. Returns
+       (games, next_cursor)"""
+    if cursor and cursor.startswith(ARCHIVE_CURSOR_PREFIX):
+        return _get_archived_games(username, status, limit,
+                                   cursor[len(ARCHIVE_CURSOR_PREFIX):])
+
+    projection = list(GAME_SUMMARY_PROJECTION)
+    if status == GameStatus.WON:
+        query = Game.query(Game.winners == username)
+    elif status == GameStatus.LOST:
+        query = Game.query(Game.loser == username)
+    else:
+        query = Game.query(Game.users == username)
+        if status == GameStatus.ACTIVE:
+            query = query.filter(Game.game_over == False)
+        elif status == GameStatus.FINISHED:
+            query = query.filter(Game.game_over == True)
+        else:
+            projection.append(Game.game_over)
+
+    try:
+        start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    except Exception:
+        raise endpoints.BadRequestException('Invalid cursor')
+    games, next_cursor, more = query.order(-Game.created).fetch_page(
+        limit, start_cursor=start_cursor, projection=projection)
+    if more and next_cursor:
+        return games, next_cursor.urlsafe()
+    if status == GameStatus.ACTIVE:
+        archived, next_cursor = [], None
+    elif len(games) == limit:
+        archived, next_cursor = [], ARCHIVE_CURSOR_PREFIX
+    else:
+        archived, next_cursor = _get_archived_games(
+            username, status, limit - len(games))
+    games.extend(archived)
+    if not games and not cursor and not User.get_by_name(username):
+        raise endpoints.NotFoundException('User does not exist')
+    return games, next_cursor
+
+
+def _get_archived_games(username, status, limit, cursor=None):
+    """Get a page of a user's archived games as Games, newest first. Returns
+       (games, next_cursor) where next_cursor is an archive cursor"""
+    if status == GameStatus.ACTIVE:
+        return [], None
+    if status == GameStatus.WON:
+        query = ArchivedGame.query(ArchivedGame.winners == username)
+    elif status == GameStatus.LOST:
+        query = ArchivedGame.query(ArchivedGame.loser == username)
+    else:
+        query = ArchivedGame.query(ArchivedGame.users == username)
+
+    try:
+        start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    except Exception:
+        raise endpoints.BadRequestException('Invalid cursor')
+    archived, next_cursor, more = query.order(
+        -ArchivedGame.created).fetch_page(limit, start_cursor=start_cursor)
+    next_cursor = (ARCHIVE_CURSOR_PREFIX + next_cursor.urlsafe()
+                   if more and next_cursor else None)
+    return [game.to_game() for game in archived], next_cursor
+
+
+@instrumented
 def get_user_by_gplus():
     """Returns User associated with gplus account"""
     g_user = endpoints.get_current_user()
     if not g_user:
         raise endpoints.UnauthorizedException('Authorization required')
-    user = User.query(User.email == g_user.email()).get()
+    user = User.get_by_email(g_user.email())
     if not user:
         raise endpoints.NotFoundException(
             'User with %s gplus account does not exist' % g_user.email())